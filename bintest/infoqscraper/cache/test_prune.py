@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+import subprocess
+
+from bintest.infoqscraper import TestInfoqscraper
+
+usage_prefix = "usage: infoqscraper cache prune"
+
+
+class TestArguments(TestInfoqscraper):
+
+    def setUp(self):
+        self.default_cmd = ["cache", "prune"]
+
+    def test_help(self):
+        output = self.run_cmd(self.default_cmd + ["--help"])
+        self.assertTrue(output.startswith(usage_prefix))
+
+    def test_prune(self):
+        output = self.run_cmd(self.default_cmd + ["--max-size", "1T"])
+        self.assertIsNotNone(re.match('\d{1,4}\.\d{2} \w{2,5} freed', output))
+
+    def test_bad_size(self):
+        try:
+            self.run_cmd(self.default_cmd + ["--max-size", "foo"])
+            self.fail("Exception expected")
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.returncode, 2)
+            self.assertTrue(e.output.decode('utf8').startswith(usage_prefix))
+
+    def test_no_size(self):
+        try:
+            self.run_cmd(self.default_cmd)
+            self.fail("Exception expected")
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.returncode, 1)
@@ -45,6 +45,10 @@ class TestArguments(TestInfoqscraper):
         output = self.run_cmd(self.default_cmd)
         self.assertIsNotNone(re.match('\d{1,4}\.\d{2} \w{2,5}', output))
 
+    def test_size_verify(self):
+        output = self.run_cmd(self.default_cmd + ["--verify"])
+        self.assertIsNotNone(re.match('\d{1,4}\.\d{2} \w{2,5}', output))
+
     def test_extra_arg(self):
         try:
             self.run_cmd(self.default_cmd + ["extra_args"])
@@ -103,6 +103,24 @@ class TestArguments(TestInfoqscraper):
             self.assertEqual(e.returncode, 2)
             self.assertTrue(e.output.decode('utf8').startswith(usage_prefix))
 
+    def test_output_with_several_presentations(self):
+        try:
+            self.run_cmd(self.default_cmd + [short_presentation_id, "Clojure-Expression-Problem", "-o", "output.avi"])
+            self.fail("Exception expected")
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.returncode, 1)
+
+    def test_bad_input_file(self):
+        self.assert_bad_command(["--input", "/bad/input/path"])
+
+    def test_empty_input_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        input_path = os.path.join(tmp_dir, "ids")
+        with open(input_path, "w") as f:
+            f.write("# No presentation\n\n")
+        self.assert_bad_command(["--input", input_path])
+        shutil.rmtree(tmp_dir)
+
     def test_bad_ffmpeg(self):
         self.assert_bad_command(["--ffmpeg", "/bad/ffmpeg/path"])
 
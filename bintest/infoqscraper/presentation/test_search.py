@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from infoqscraper import catalog
+from infoqscraper import test
+
+from bintest.infoqscraper import TestInfoqscraper
+
+usage_prefix = "usage: infoqscraper presentation search"
+
+
+class TestArguments(TestInfoqscraper):
+
+    def setUp(self):
+        self.default_cmd = ["presentation", "search"]
+        self.data_home = tempfile.mkdtemp()
+        self.prev_data_home = os.environ.get("XDG_DATA_HOME")
+        os.environ["XDG_DATA_HOME"] = self.data_home
+
+    def tearDown(self):
+        if self.prev_data_home is None:
+            del os.environ["XDG_DATA_HOME"]
+        else:
+            os.environ["XDG_DATA_HOME"] = self.prev_data_home
+        shutil.rmtree(self.data_home)
+
+    def test_help(self):
+        output = self.run_cmd(self.default_cmd + ["--help"])
+        self.assertTrue(output.startswith(usage_prefix))
+
+    def test_empty_catalog(self):
+        try:
+            self.run_cmd(self.default_cmd + ["java"])
+            self.fail("Exception expected")
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.returncode, 1)
+
+    def test_search(self):
+        catalog.Catalog().update(test.ListingClient(30))
+        output = self.run_cmd(self.default_cmd + ["description"])
+        self.assertEqual(output.count("Id: "), 10)
+        output = self.run_cmd(self.default_cmd + ["-s", "-n", "100", "--author", "speaker 3", "--since", "2014-06-20"])
+        self.assertEqual(output.split(), ["p3", "p8"])
+
+    def test_bad_date(self):
+        try:
+            self.run_cmd(self.default_cmd + ["--since", "yesterday"])
+            self.fail("Exception expected")
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.returncode, 2)
+            self.assertTrue(e.output.decode('utf8').startswith(usage_prefix))
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""asyncio counterparts of the InfoQ client and of the scraping API.
+
+A single event loop can drive many concurrent fetches without a thread per request.
+Requires Python >= 3.6, the module is not installed with older versions.
+
+Proxies are not supported. Unlike client.InfoQ, the http_proxy and https_proxy environment
+variables are ignored and InfoQ is always connected to directly.
+"""
+
+import asyncio
+import http.client
+import http.cookiejar
+import io
+import os
+import shutil
+import ssl
+import urllib.parse
+import urllib.request
+
+from infoqscraper import cache
+from infoqscraper import scrap
+from infoqscraper import AuthenticationError, DownloadError
+from infoqscraper.client import get_url, INFOQ_404_URL, _conditional_headers
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 10
+
+
+class InfoQ(object):
+    """ asyncio InfoQ web client
+
+    Mirror client.InfoQ but every method doing I/O is a coroutine. Connections are kept alive
+    and shared by all the coroutines using the client. The cache is blocking, it is accessed
+    from the default executor of the event loop. Proxies are not supported.
+
+    Attributes:
+        authenticated:       If logged in or not
+        cache:              None if caching is disable. A Cache object otherwise
+        max_connections_per_host: Upper bound of concurrent requests sent to a single host
+        chunk_size:         Number of bytes read at once when a resource is streamed to disk
+    """
+
+    def __init__(self, cache_enabled=False, max_connections_per_host=4, chunk_size=64 * 1024,
+                 cache_max_size=None, cache_compression=None):
+        self.authenticated = False
+        self.cookie_jar = http.cookiejar.CookieJar()
+        # Fail now rather than when the cache is enabled
+        cache.check_compression(cache_compression)
+        self.cache = None
+        self.cache_max_size = cache_max_size
+        self.cache_compression = cache_compression
+        if cache_enabled:
+            self.enable_cache()
+
+        self.max_connections_per_host = max_connections_per_host
+        self.chunk_size = chunk_size
+        self._host_slots = {}
+        self._idle = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def enable_cache(self):
+        if not self.cache:
+            self.cache = cache.XDGCache(max_size=self.cache_max_size, compression=self.cache_compression)
+
+    def close(self):
+        """ Close all the idle connections """
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for reader, writer in conns:
+                writer.close()
+
+    async def login(self, username, password):
+        """ Log in.
+
+        AuthenticationFailedException exception is raised if authentication fails.
+        """
+        url = get_url("/login.action", scheme="https")
+        params = {
+            'username': username,
+            'password': password,
+            'submit-login': '',
+        }
+        try:
+            response = await self._open(url, urllib.parse.urlencode(params).encode('ascii'))
+        except (OSError, EOFError, http.client.HTTPException) as e:
+            raise AuthenticationError("Login failed: %s" % e)
+
+        if not "loginAction.jsp" in response.url:
+            raise AuthenticationError("Login failed. Unexpected redirection: %s" % response.url)
+        if not "resultMessage=success" in response.url:
+            raise AuthenticationError("Login failed.")
+
+        self.authenticated = True
+
+    async def fetch(self, url, max_age=None):
+        """ Fetch the resource specified and return its content, from the cache if enabled.
+
+            Args:
+                url: The url of the resource
+                max_age: Fetch the resource again if cached more than max_age seconds ago.
+                         Cached resources never expire if None.
+        """
+        if self.cache:
+            content = await _blocking(self.cache.get_content, url, max_age)
+            if not content:
+                validators = await _blocking(self.cache.get_validators, url)
+                content = await self._fetch_and_put(url, _conditional_headers(*validators))
+            if content is None:
+                # Not modified, unless evicted in the meantime
+                content = await _blocking(self.cache.refresh, url)
+            if content is None:
+                content = await self._fetch_and_put(url)
+        else:
+            content = await self.fetch_no_cache(url)
+
+        return content
+
+    async def _fetch_and_put(self, url, headers=None):
+        """ Fetch the resource specified, put it in the cache with its validators and return
+            its content. None is returned if the request is conditional and the resource was
+            not modified.
+        """
+        response = await self._checked_open(url, headers=headers)
+        if response.status == 304:
+            return None
+        await _blocking(self.cache.put_content, url, response.body, response.headers.get("ETag"),
+                        response.headers.get("Last-Modified"))
+        return response.body
+
+    async def fetch_no_cache(self, url):
+        """ Fetch the resource specified and return its content.
+
+            DownloadError is raised if the resource cannot be fetched.
+        """
+        response = await self._checked_open(url)
+        return response.body
+
+    async def stream(self, url, f):
+        """ Fetch the resource specified and write its content into the file object f,
+            self.chunk_size bytes at a time. The content is never held in memory.
+
+            DownloadError is raised if the resource cannot be fetched.
+        """
+        await self._checked_open(url, sink=f.write)
+
+    async def _checked_open(self, url, sink=None, headers=None):
+        try:
+            response = await self._open(url, sink=sink, headers=headers)
+        except (OSError, EOFError, http.client.HTTPException) as e:
+            raise DownloadError("Failed to get %s: %s" % (url, e))
+
+        if response.status == 304 and headers:
+            return response
+
+        # InfoQ does not send a 404 but a 302 redirecting to a valid URL...
+        if response.status != 200 or response.url == INFOQ_404_URL:
+            raise DownloadError("%s not found" % url)
+        return response
+
+    async def download(self, url, dir_path, filename=None):
+        """ Download the resources specified by url into dir_path. The resulting
+            file path is returned.
+
+            The resource is streamed to disk, then put in the cache if enabled.
+
+            DownloadError is raised the resources cannot be downloaded.
+        """
+        if not filename:
+            filename = url.rsplit('/', 1)[1]
+        path = os.path.join(dir_path, filename)
+
+        # The file might be a hard link to a cached resource, never write through it
+        if os.path.exists(path):
+            os.unlink(path)
+
+        cache_path = await _blocking(self.cache.get_path, url) if self.cache else None
+        if cache_path:
+            await _blocking(shutil.copyfile, cache_path, path)
+            return path
+
+        try:
+            with open(path, "wb") as f:
+                await self.stream(url, f)
+        except BaseException:
+            os.unlink(path)
+            raise
+
+        if self.cache:
+            await _blocking(self.cache.put_path, url, path)
+
+        return path
+
+    async def download_all(self, urls, dir_path):
+        """ Download all the resources specified by urls into dir_path. The resulting
+            file paths is returned in the same order than urls.
+
+            All the downloads are started at once, max_connections_per_host bounds the number
+            of requests actually in flight.
+
+            DownloadError is raised if at least one of the resources cannot be downloaded.
+            In the case already downloaded resources are erased.
+        """
+        tasks = [asyncio.ensure_future(self.download(url, dir_path)) for url in urls]
+        if not tasks:
+            return []
+
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+        filenames = []
+        error = None
+        for task in tasks:
+            if task.cancelled():
+                continue
+            if task.exception() is None:
+                filenames.append(task.result())
+            elif error is None:
+                error = task.exception()
+
+        if error is not None:
+            for filename in filenames:
+                os.remove(filename)
+            raise error
+
+        return filenames
+
+    def _host_slot(self, host):
+        """ Return the semaphore bounding the number of concurrent requests to host """
+        try:
+            return self._host_slots[host]
+        except KeyError:
+            slot = asyncio.Semaphore(self.max_connections_per_host)
+            self._host_slots[host] = slot
+            return slot
+
+    async def _open(self, url, data=None, sink=None, headers=None):
+        """ Send a request, follow the redirections and return the final _Response.
+
+        If sink is specified, the body of a successful response is given chunk by chunk to sink
+        rather than stored into the response. Extra request headers can be specified.
+        """
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = await self._request(url, data, sink, headers)
+            location = response.headers.get("Location")
+            if response.status not in _REDIRECT_CODES or not location:
+                return response
+
+            url = urllib.parse.urljoin(url, location)
+            if response.status in (301, 302, 303):
+                data = None
+
+        raise http.client.HTTPException("Too many redirections")
+
+    async def _request(self, url, data, sink, extra_headers=None):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        selector = parts.path or "/"
+        if parts.query:
+            selector += "?" + parts.query
+
+        request = urllib.request.Request(url, data)
+        self.cookie_jar.add_cookie_header(request)
+        headers = {
+            "Host": parts.netloc,
+            "Connection": "keep-alive",
+            "Accept-Encoding": "identity",
+        }
+        if data is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["Content-Length"] = str(len(data))
+        headers.update(request.unredirected_hdrs)
+        headers.update(request.headers)
+        headers.update(extra_headers or {})
+
+        async with self._host_slot(key[1:]):
+            while True:
+                reader, writer, reused = await self._connect(key)
+                try:
+                    response, keep_alive = await self._exchange(reader, writer, request.get_method(), selector,
+                                                                headers, data, sink)
+                    break
+                except _ConnectionLost:
+                    writer.close()
+                    if not reused:
+                        raise
+                    # The server closed the idle connection in the meantime
+                except BaseException:
+                    writer.close()
+                    raise
+
+            if keep_alive:
+                self._idle.setdefault(key, []).append((reader, writer))
+            else:
+                writer.close()
+
+        response.url = url
+        self.cookie_jar.extract_cookies(response, request)
+        return response
+
+    async def _connect(self, key):
+        """ Return a (reader, writer, reused) tuple. A new connection is opened if none is idle. """
+        conns = self._idle.get(key)
+        if conns:
+            reader, writer = conns.pop()
+            return reader, writer, True
+
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == "https" else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        return reader, writer, False
+
+    async def _exchange(self, reader, writer, method, selector, headers, data, sink):
+        """ Send a request over a connection and read the response. Return a (response, keep_alive) tuple. """
+        lines = ["%s %s HTTP/1.1" % (method, selector)]
+        lines += ["%s: %s" % (name, value) for name, value in headers.items()]
+        try:
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+            if data is not None:
+                writer.write(data)
+            await writer.drain()
+            status_line = await reader.readline()
+        except OSError:
+            status_line = None
+        if not status_line:
+            raise _ConnectionLost("Connection closed by the server")
+        try:
+            version, status = status_line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        raw_headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            raw_headers.append(line)
+        response_headers = http.client.parse_headers(io.BytesIO(b"".join(raw_headers) + b"\r\n"))
+
+        if status != 200:
+            sink = None
+        body, complete = await self._read_body(reader, method, status, response_headers, sink)
+        keep_alive = complete and version == "HTTP/1.1" \
+            and response_headers.get("Connection", "").lower() != "close"
+
+        return _Response(status, response_headers, body), keep_alive
+
+    async def _read_body(self, reader, method, status, headers, sink=None):
+        """ Read a response body. Return a (body, delimited) tuple, delimited is False if the body
+            was terminated by the server closing the connection.
+
+            If sink is specified, the body is given to sink self.chunk_size bytes at a time and
+            an empty body is returned.
+        """
+        if method == "HEAD" or status < 200 or status in (204, 304):
+            return b"", True
+
+        chunks = []
+        write = sink or chunks.append
+
+        async def copy(length):
+            while length > 0:
+                chunk = await reader.readexactly(min(length, self.chunk_size))
+                write(chunk)
+                length -= len(chunk)
+
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if size == 0:
+                    break
+                await copy(size)
+                await reader.readline()
+            # Skip trailers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            delimited = True
+        elif headers.get("Content-Length") is not None:
+            await copy(int(headers["Content-Length"]))
+            delimited = True
+        else:
+            while True:
+                chunk = await reader.read(self.chunk_size)
+                if not chunk:
+                    break
+                write(chunk)
+            delimited = False
+
+        return b"".join(chunks), delimited
+
+
+class _ConnectionLost(ConnectionError):
+    """ The connection was closed before any response was received """
+
+
+class _Response(object):
+    """ A fully read HTTP response
+
+    Attributes:
+        url: The requested url
+        status: The status code
+        headers: A http.client.HTTPMessage
+        body: The response content
+    """
+
+    def __init__(self, status, headers, body):
+        self.url = None
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def info(self):
+        # Required by http.cookiejar
+        return self.headers
+
+
+async def _blocking(func, *args):
+    """ Run a blocking function in the default executor of the event loop, return its result """
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def get_summaries(client, filter=None, parser=None):
+    """ Asynchronously generate presentation summaries in a reverse chronological order.
+
+     A filter class can be supplied to filter summaries or bound the fetching process.
+     The pages are parsed with the specified BeautifulSoup parser, scrap.DEFAULT_PARSER if not specified.
+    """
+    index = 0
+    while True:
+        content = await client.fetch(get_url("/presentations/%s" % index), max_age=scrap.LISTING_MAX_AGE)
+        summaries = scrap._RightBarPage(client, index, content=content.decode('utf-8'), parser=parser).summaries()
+        if not summaries:
+            return
+
+        index += len(summaries)
+        if filter is not None:
+            try:
+                summaries = filter.filter(summaries)
+            except StopIteration:
+                return
+
+        for summary in summaries:
+            yield summary
+
+
+async def get_presentation(client, id, parser=None):
+    """ Fetch the presentation page and return the matching scrap.Presentation.
+
+    Its metadata are read from the cache, or extracted, in the default executor. The page is only
+    cached for anonymous clients, its markup is not the same if authenticated.
+    """
+    url = get_url("/presentations/" + id)
+    if client.authenticated:
+        content = await client.fetch_no_cache(url)
+    else:
+        content = await client.fetch(url, max_age=scrap.PRESENTATION_MAX_AGE)
+
+    def build():
+        presentation = scrap.Presentation(client, id, content=content.decode('utf-8'), parser=parser)
+        presentation.metadata
+        return presentation
+
+    return await _blocking(build)
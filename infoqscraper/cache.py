@@ -22,53 +22,430 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import contextlib
 import errno
+import hashlib
+import json
 import os
+import re
 import shutil
+import sqlite3
+import time
+import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class Error(Exception):
     pass
 
 
+_SCHEMA_VERSION = 5
+
+# Objects are spread over _SHARD_LEVELS levels of directories named after the first digest
+# characters. Each level has a fixed fan-out of 16 ** _SHARD_WIDTH directories.
+_SHARD_LEVELS = 2
+_SHARD_WIDTH = 2
+
+# Reads only update the access time of an object if older than that many seconds. A coarse LRU
+# order spares readers the write lock of the index, shared by all the processes.
+_ATIME_RESOLUTION = 60
+
+# os.rename does not overwrite an existing file on Windows
+replace_file = getattr(os, "replace", os.rename)
+
+# Compressed objects are named after the digest of their uncompressed content plus the codec
+# suffix. Media are already compressed, trying to compress them again would be a waste of time.
+_CODEC_SUFFIXES = {
+    "zlib": ".zlib",
+    "zstd": ".zst",
+}
+_INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    ".jpg", ".jpeg", ".png", ".gif", ".swf", ".mp4", ".mp3", ".flv", ".ogg", ".avi", ".pdf", ".zip", ".gz",
+])
+_MIN_COMPRESSIBLE_SIZE = 512
+
+
+def check_compression(compression):
+    """ Checks that a cache compression codec is known and available.
+
+    Raises:
+        ValueError: If the codec is unknown, or zstd without the zstandard module
+    """
+    if compression is not None and compression not in _CODEC_SUFFIXES:
+        raise ValueError("Unknown cache compression %s" % compression)
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd cache compression requires the zstandard module")
+
+
+def find_cache_dir():
+    """ Returns the infoqscraper directory of the XDG_CACHE_HOME directory """
+    home = os.path.expanduser("~")
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(home, ".cache"))
+    return os.path.join(xdg_cache_home, "infoqscraper")
+
+
 class XDGCache(object):
     """A disk cache for resources.
 
     Remote resources can be cached to avoid to fetch them several times from the web server.
     The resources are stored into the XDG_CACHE_HOME_DIR.
 
+    The cache is content-addressed. Each distinct content is stored once, as an object named
+    after its SHA-1 digest, and an index maps each url to the digest of its content. Identical
+    resources served under different urls, like shared template slides, take no extra space.
+
+    The size of the cache can be bounded. Least recently used contents are then evicted, with
+    all the urls pointing to them, when a new content is put.
+
+    Compressible resources stored with put_content, like HTML pages, can be compressed with zstd
+    (requires the zstandard module) or zlib. The compression is chosen per entry and get_content
+    decompresses transparently.
+
+    Each url records when its content was put, so that callers can bound the age of the
+    contents they accept, and the HTTP validators (ETag, Last-Modified) of the content, so that
+    stale contents can be revalidated rather than downloaded again.
+
+    The cache also keeps the metadata extracted from presentation pages, so that unchanged pages
+    do not have to be parsed again.
+
+    Several threads or processes can safely share a cache. Objects are written into a temporary
+    file then atomically renamed, so a partially written object is never visible. Index updates
+    and object deletions are done in exclusive index transactions.
+
     Attributes:
         dir: Where to store the cached resources
+        max_size: Upper bound of the cache size in bytes, None if unbounded
+        compression: The codec used by put_content, "zstd", "zlib" or None if disabled
 
     """
 
-    def __init__(self):
+    def __init__(self, max_size=None, compression=None):
+        """
+        Raises:
+            ValueError: If the compression codec is unknown or not available
+        """
+        check_compression(compression)
         self.dir = self._find_dir()
+        self.max_size = max_size
+        self.compression = compression
 
     def _find_dir(self):
-        home = os.path.expanduser("~")
-        xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(home, ".cache"))
-        return os.path.join(xdg_cache_home, "infoqscraper", "resources")
+        return os.path.join(find_cache_dir(), "resources")
+
+    @property
+    def _objects_dir(self):
+        return os.path.join(self.dir, "objects")
+
+    @property
+    def _tmp_dir(self):
+        return os.path.join(self.dir, "tmp")
 
-    def _url_to_path(self, url):
-        return os.path.join(self.dir, url)
+    @property
+    def _index_path(self):
+        return os.path.join(self.dir, "index.sqlite")
+
+    def _object_path(self, digest):
+        shards = [digest[i:i + _SHARD_WIDTH] for i in range(0, _SHARD_LEVELS * _SHARD_WIDTH, _SHARD_WIDTH)]
+        return os.path.join(self._objects_dir, *(shards + [digest[_SHARD_LEVELS * _SHARD_WIDTH:]]))
+
+    @contextlib.contextmanager
+    def _index(self, write=False):
+        """Returns a connection to the index within a transaction. Changes are committed on exit.
+
+        A write transaction excludes all the other writers, including other processes, until
+        committed.
+
+        The entries table maps urls to digests and records when they were put and their validators.
+        The objects table records the size and the last
+        access time of each stored content. The stats table keeps the total size of the objects,
+        maintained by triggers, so that the cache size is known without walking the cache. The
+        metadata table maps presentation ids to the metadata extracted from a given page by a given
+        version of the extractor.
+        """
+        self._makedirs(self.dir)
+        try:
+            # Transactions are handled explicitly
+            conn = sqlite3.connect(self._index_path, timeout=60, isolation_level=None)
+            if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                self._upgrade_schema(conn)
+        except sqlite3.Error as e:
+            raise Error('Failed to open cache index %s: %s' % (self._index_path, e))
 
-    def get_content(self, url):
+        try:
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _upgrade_schema(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        # Another process may have upgraded the index before we got the lock
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._create_schema(conn)
+        if version < 2:
+            # Urls put by older versions are considered as put now
+            conn.execute("ALTER TABLE entries ADD COLUMN mtime REAL NOT NULL DEFAULT 0")
+            conn.execute("UPDATE entries SET mtime = ?", (time.time(),))
+        if version < 3:
+            conn.execute("ALTER TABLE entries ADD COLUMN etag TEXT")
+            conn.execute("ALTER TABLE entries ADD COLUMN last_modified TEXT")
+        if version < 4:
+            conn.execute("CREATE TABLE metadata (id TEXT PRIMARY KEY, digest TEXT NOT NULL, data TEXT NOT NULL)")
+        if version < 5:
+            # Metadata put by older versions are extracted again
+            conn.execute("ALTER TABLE metadata ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conn.execute("PRAGMA user_version = %d" % _SCHEMA_VERSION)
+        conn.execute("COMMIT")
+
+    def _create_schema(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        conn.execute("CREATE TABLE IF NOT EXISTS objects "
+                     "(digest TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS objects_atime ON objects (atime)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO stats (name, value) "
+                     "SELECT 'size', COALESCE(SUM(size), 0) FROM objects")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS objects_insert AFTER INSERT ON objects BEGIN "
+                     "UPDATE stats SET value = value + NEW.size WHERE name = 'size'; END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS objects_delete AFTER DELETE ON objects BEGIN "
+                     "UPDATE stats SET value = value - OLD.size WHERE name = 'size'; END")
+
+    def _makedirs(self, dir):
+        try:
+            os.makedirs(dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise Error('Failed to create cache directory %s' % dir)
+
+    def _lookup(self, url, max_age=None):
+        """Returns the digest of a cached resource or None if not in the cache.
+
+        The resource is looked up within a read transaction. The access time of the content is
+        only updated, within a write transaction, if older than _ATIME_RESOLUTION seconds.
+
+        Args:
+            url: The url of the resource
+            max_age: The resource is ignored if put more than max_age seconds ago. No limit if None.
+        """
+        if not os.path.exists(self._index_path):
+            return None
+
+        with self._index() as index:
+            row = index.execute("SELECT entries.digest, entries.mtime, objects.atime FROM entries "
+                                "LEFT JOIN objects ON objects.digest = entries.digest WHERE url = ?",
+                                (url,)).fetchone()
+        if row is None:
+            return None
+        digest, mtime, atime = row
+        now = time.time()
+        if max_age is not None and now - mtime > max_age:
+            return None
+
+        if atime is not None and now - atime > _ATIME_RESOLUTION:
+            with self._index(write=True) as index:
+                index.execute("UPDATE objects SET atime = ? WHERE digest = ?", (now, digest))
+        return digest
+
+    def _store(self, digest, write):
+        """Creates the object digest if it does not exist yet.
+
+        Args:
+            digest: The digest of the content
+            write: A function filling the temporary file whose path is given as argument.
+                   The file is then renamed as the object.
+        """
+        cache_path = self._object_path(digest)
+        if os.path.exists(cache_path):
+            return
+
+        self._makedirs(os.path.dirname(cache_path))
+        self._makedirs(self._tmp_dir)
+        tmp_path = os.path.join(self._tmp_dir, uuid.uuid4().hex)
+        try:
+            write(tmp_path)
+            replace_file(tmp_path, cache_path)
+        except (IOError, OSError) as e:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise Error('Failed to store %s: %s' % (cache_path, e))
+
+    def _put(self, url, digest, write, etag=None, last_modified=None):
+        """Stores the object digest then points url to it.
+
+        The previous object is deleted if no longer referenced. If the cache size exceeds max_size,
+        least recently used objects are evicted.
+        """
+        self._store(digest, write)
+        with self._index(write=True) as index:
+            # Objects are only deleted within write transactions. Now that we are in one, make sure
+            # that the object has not been evicted by a concurrent writer in the meantime.
+            self._store(digest, write)
+            size = os.path.getsize(self._object_path(digest))
+
+            row = index.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+            now = time.time()
+            index.execute("INSERT OR REPLACE INTO entries (url, digest, mtime, etag, last_modified) "
+                          "VALUES (?, ?, ?, ?, ?)", (url, digest, now, etag, last_modified))
+            # Not INSERT OR REPLACE, the implicit delete would not fire objects_delete
+            index.execute("INSERT OR IGNORE INTO objects (digest, size, atime) VALUES (?, ?, ?)", (digest, size, now))
+            index.execute("UPDATE objects SET atime = ? WHERE digest = ?", (now, digest))
+            if row and row[0] != digest:
+                orphan = row[0]
+                count = index.execute("SELECT COUNT(*) FROM entries WHERE digest = ?", (orphan,)).fetchone()[0]
+                if count == 0:
+                    self._delete_object(index, orphan)
+
+        if self.max_size is not None:
+            self._evict(self.max_size, keep=digest)
+
+    def _delete_object(self, index, digest):
+        """Deletes an object and all the urls pointing to it."""
+        index.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+        index.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        try:
+            os.unlink(self._object_path(digest))
+        except OSError:
+            pass
+
+    def _evict(self, max_size, keep=None):
+        """Deletes least recently used objects until the cache size is at most max_size bytes.
+
+        Returns:
+            The number of bytes freed
+        """
+        freed = 0
+        with self._index(write=True) as index:
+            total = self._recorded_size(index)
+            offset = 0
+            while total - freed > max_size:
+                lru = index.execute("SELECT digest, size FROM objects ORDER BY atime LIMIT 256 OFFSET ?",
+                                    (offset,)).fetchall()
+                if not lru:
+                    break
+                for digest, size in lru:
+                    if total - freed <= max_size:
+                        break
+                    if digest == keep:
+                        offset += 1
+                        continue
+                    self._delete_object(index, digest)
+                    freed += size
+
+        return freed
+
+    def _recorded_size(self, index):
+        return index.execute("SELECT value FROM stats WHERE name = 'size'").fetchone()[0]
+
+    def get_content(self, url, max_age=None):
         """Returns the content of a cached resource.
 
         Args:
             url: The url of the resource
+            max_age: Ignore the cached resource if put more than max_age seconds ago. No limit if None.
 
         Returns:
-            The content of the cached resource or None if not in the cache
+            The content of the cached resource or None if not in the cache or too old
         """
-        cache_path = self._url_to_path(url)
+        digest = self._lookup(url, max_age)
+        if digest is None:
+            return None
+
         try:
-            with open(cache_path, 'rb') as f:
-                return f.read()
+            with open(self._object_path(digest), 'rb') as f:
+                content = f.read()
         except IOError:
             return None
 
+        if digest.endswith(_CODEC_SUFFIXES["zlib"]):
+            return zlib.decompress(content)
+        if digest.endswith(_CODEC_SUFFIXES["zstd"]):
+            if zstandard is None:
+                return None
+            return zstandard.ZstdDecompressor().decompress(content)
+        return content
+
+    def get_validators(self, url):
+        """Returns the HTTP validators of a cached resource, fresh or not.
+
+        Args:
+            url: The url of the resource
+
+        Returns:
+            An (etag, last_modified) tuple. Unknown validators are None.
+        """
+        if not os.path.exists(self._index_path):
+            return None, None
+
+        with self._index() as index:
+            row = index.execute("SELECT etag, last_modified FROM entries WHERE url = ?", (url,)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def refresh(self, url):
+        """Marks a cached resource as just put, typically once revalidated by the web server.
+
+        Args:
+            url: The url of the resource
+
+        Returns:
+            The content of the cached resource or None if not in the cache
+        """
+        if not os.path.exists(self._index_path):
+            return None
+
+        with self._index(write=True) as index:
+            index.execute("UPDATE entries SET mtime = ? WHERE url = ?", (time.time(), url))
+        return self.get_content(url)
+
+    def get_metadata(self, id, digest, version):
+        """Returns the metadata extracted from a presentation page.
+
+        Args:
+            id: The presentation id
+            digest: The SHA-1 digest of the presentation page
+            version: The version of the metadata extractor
+
+        Returns:
+            The metadata dictionary or None if not in the cache, extracted from another page or by
+            another version of the extractor
+        """
+        if not os.path.exists(self._index_path):
+            return None
+
+        with self._index() as index:
+            row = index.execute("SELECT data FROM metadata WHERE id = ? AND digest = ? AND version = ?",
+                                (id, digest, version)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_metadata(self, id, digest, version, metadata):
+        """Stores the metadata extracted from a presentation page, replacing any previous one.
+
+        Args:
+            id: The presentation id
+            digest: The SHA-1 digest of the presentation page
+            version: The version of the metadata extractor
+            metadata: A dictionary serializable to JSON
+
+        Raises:
+            Error: If the metadata cannot be put in cache
+        """
+        with self._index(write=True) as index:
+            index.execute("INSERT OR REPLACE INTO metadata (id, digest, version, data) VALUES (?, ?, ?, ?)",
+                          (id, digest, version, json.dumps(metadata, sort_keys=True)))
+
     def get_path(self, url):
         """Returns the path of a cached resource.
 
@@ -76,39 +453,67 @@ class XDGCache(object):
             url: The url of the resource
 
         Returns:
-            The path to the cached resource or None if not in the cache
+            The path to the cached resource or None if not in the cache or stored compressed
         """
-        cache_path = self._url_to_path(url)
+        digest = self._lookup(url)
+        if digest is None or digest.endswith(tuple(_CODEC_SUFFIXES.values())):
+            return None
+
+        cache_path = self._object_path(digest)
         if os.path.exists(cache_path):
             return cache_path
 
         return None
 
-    def put_content(self, url, content):
+    def put_content(self, url, content, etag=None, last_modified=None):
         """Stores the content of a resource into the disk cache.
 
+        The content is compressed if worth it, see self.compression.
+
         Args:
             url: The url of the resource
             content: The content of the resource
+            etag: The ETag header of the resource, if any
+            last_modified: The Last-Modified header of the resource, if any
 
         Raises:
             CacheError: If the content cannot be put in cache
         """
-        cache_path = self._url_to_path(url)
+        digest = hashlib.sha1(content).hexdigest()
+        data = content
+        compressed = self._compress(url, content)
+        if compressed is not None:
+            digest += _CODEC_SUFFIXES[self.compression]
+            data = compressed
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._put(url, digest, write, etag, last_modified)
+
+    def _compress(self, url, content):
+        """Returns the compressed content or None if not worth it."""
+        if self.compression is None or len(content) < _MIN_COMPRESSIBLE_SIZE:
+            return None
 
-        # Ensure that cache directories exist
-        try:
-            dir = os.path.dirname(cache_path)
-            os.makedirs(dir)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise Error('Failed to create cache directories for ' % cache_path)
+        ext = os.path.splitext(url.split('?', 1)[0])[1].lower()
+        if ext in _INCOMPRESSIBLE_EXTENSIONS:
+            return None
 
-        try:
-            with open(cache_path, 'wb') as f:
-                f.write(content)
-        except IOError:
-            raise Error('Failed to cache content as %s for %s' % (cache_path, url))
+        if self.compression == "zstd":
+            compressed = zstandard.ZstdCompressor().compress(content)
+        elif self.compression == "zlib":
+            compressed = zlib.compress(content, 6)
+        else:
+            raise ValueError("Unsupported compression: %s" % self.compression)
+
+        # Some resources have no extension, make sure that compression is useful
+        if len(compressed) > len(content) * 0.9:
+            return None
+        return compressed
 
     def put_path(self, url, path):
         """Puts a resource already on disk into the disk cache.
@@ -120,31 +525,103 @@ class XDGCache(object):
         Raises:
             CacheError: If the file cannot be put in cache
         """
-        cache_path = self._url_to_path(url)
-
-        # Ensure that cache directories exist
-        try:
-            dir = os.path.dirname(cache_path)
-            os.makedirs(dir)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise Error('Failed to create cache directories for ' % cache_path)
-
-        # Remove the resource already exist
         try:
-            os.unlink(cache_path)
-        except OSError:
-            pass
+            digest = _file_digest(path)
+        except IOError:
+            raise Error('Failed to read %s for %s' % (path, url))
 
-        try:
-            # First try hard link to avoid wasting disk space & overhead
-            os.link(path, cache_path)
-        except OSError:
+        def write(tmp_path):
             try:
+                # First try hard link to avoid wasting disk space & overhead
+                os.link(path, tmp_path)
+            except OSError:
                 # Use file copy as fallaback
-                shutil.copyfile(path, cache_path)
-            except IOError:
-                raise Error('Failed to cache %s as %s for %s' % (path, cache_path, url))
+                shutil.copyfile(path, tmp_path)
+                with open(tmp_path, 'rb') as f:
+                    os.fsync(f.fileno())
+
+        self._put(url, digest, write)
+
+    def prune(self, max_size=None):
+        """Evicts least recently used resources until the cache fits in max_size bytes.
+
+        Args:
+            max_size: The size to reach, self.max_size if not specified
+
+        Returns:
+            The number of bytes freed
+
+        Raises:
+            ValueError: If no size is specified and the cache is unbounded
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            raise ValueError("No maximum cache size specified")
+
+        if not os.path.exists(self._index_path):
+            return 0
+
+        return self._evict(max_size)
+
+    def migrate(self):
+        """Converts the cache to the current layout, in place.
+
+        Resources stored by infoqscraper <= 0.1.5 as files named after their url are moved into the
+        object store. Objects stored with another sharding are moved to their current location.
+
+        Returns:
+            The number of migrated files
+
+        Raises:
+            CacheError: If a resource cannot be migrated
+        """
+        if not os.path.exists(self.dir):
+            return 0
+
+        return self._migrate_url_files() + self._reshard_objects()
+
+    def _migrate_url_files(self):
+        count = 0
+        reserved = [self._objects_dir, self._tmp_dir]
+        for dir_path, dir_names, filenames in os.walk(self.dir, topdown=True):
+            dir_names[:] = [d for d in dir_names if os.path.join(dir_path, d) not in reserved]
+            for f in filenames:
+                path = os.path.join(dir_path, f)
+                if dir_path == self.dir and f.startswith(os.path.basename(self._index_path)):
+                    continue
+
+                # os.path.join() kept the url as is but the file system collapsed the double slash
+                url = os.path.relpath(path, self.dir).replace(os.sep, "/")
+                url = re.sub(r'^([a-z]+):/(?!/)', r'\1://', url)
+                self.put_path(url, path)
+                os.unlink(path)
+                count += 1
+
+        self._remove_empty_dirs(self.dir, keep=reserved)
+        return count
+
+    def _reshard_objects(self):
+        count = 0
+        with self._index(write=True):
+            for dir_path, dir_names, filenames in os.walk(self._objects_dir):
+                for f in filenames:
+                    path = os.path.join(dir_path, f)
+                    digest = os.path.relpath(path, self._objects_dir).replace(os.sep, "")
+                    if not re.match(r'^[0-9a-f]{40}(\.\w+)?$', digest) or path == self._object_path(digest):
+                        continue
+
+                    self._makedirs(os.path.dirname(self._object_path(digest)))
+                    replace_file(path, self._object_path(digest))
+                    count += 1
+
+        self._remove_empty_dirs(self._objects_dir)
+        return count
+
+    def _remove_empty_dirs(self, top, keep=()):
+        for dir_path, dir_names, filenames in os.walk(top, topdown=False):
+            if dir_path != top and dir_path not in keep and not os.listdir(dir_path):
+                os.rmdir(dir_path)
 
     def clear(self):
         """Delete all the cached resources.
@@ -156,10 +633,51 @@ class XDGCache(object):
 
     @property
     def size(self):
-        """Returns the size of the cache in bytes."""
-        total_size = 0
-        for dir_path, dir_names, filenames in os.walk(self.dir):
-            for f in filenames:
-                fp = os.path.join(dir_path, f)
-                total_size += os.path.getsize(fp)
+        """Returns the size of the cache in bytes, as recorded by the index."""
+        if not os.path.exists(self._index_path):
+            return 0
+
+        with self._index() as index:
+            return self._recorded_size(index)
+
+    def verify_size(self):
+        """Walks the whole cache to compute its size in bytes.
+
+        The index is fixed if it does not match: urls pointing to missing objects are removed, the
+        sizes of the objects are read again and the recorded size is updated. Objects missing
+        from the index, e.g. left by a process killed while putting them, are deleted since they
+        could never be evicted.
+        """
+        if not os.path.exists(self._index_path):
+            return 0
+
+        with self._index(write=True) as index:
+            sizes = dict(index.execute("SELECT digest, size FROM objects"))
+            for digest, size in sizes.items():
+                path = self._object_path(digest)
+                if not os.path.exists(path):
+                    self._delete_object(index, digest)
+                elif os.path.getsize(path) != size:
+                    index.execute("UPDATE objects SET size = ? WHERE digest = ?", (os.path.getsize(path), digest))
+
+            for dir_path, dir_names, filenames in os.walk(self._objects_dir):
+                for f in filenames:
+                    path = os.path.join(dir_path, f)
+                    digest = os.path.relpath(path, self._objects_dir).replace(os.sep, "")
+                    # Objects stored with another sharding are left to migrate()
+                    if digest not in sizes and self._object_path(digest) == path:
+                        os.unlink(path)
+
+            total_size = index.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            index.execute("UPDATE stats SET value = ? WHERE name = 'size'", (total_size,))
+
         return total_size
+
+
+def _file_digest(path, chunk_size=64 * 1024):
+    """Returns the SHA-1 digest of a file, read chunk by chunk."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
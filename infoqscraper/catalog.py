@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import datetime
+import errno
+import os
+import re
+import sqlite3
+
+from infoqscraper import scrap
+
+
+class Error(Exception):
+    pass
+
+
+_SCHEMA_VERSION = 2
+
+_DATE_FORMAT = "%Y-%m-%d"
+
+# How many summaries are written to the catalog at once while updating it
+_BATCH_SIZE = 50
+
+
+class Catalog(object):
+    """A local index of the presentation summaries.
+
+    The summaries are stored into a SQLite database of the XDG_DATA_HOME directory, with a
+    full-text index of their title, description and author. The whole archive can then be
+    searched without fetching any listing page.
+
+    The full-text index uses the FTS5 SQLite extension, or FTS4 if FTS5 is not available.
+
+    The catalog records a high-water mark, the newest presentation known such that all the older
+    ones are known too. A sync stops paging the listing as soon as it reaches it.
+
+    Attributes:
+        path: The path of the SQLite database
+    """
+
+    def __init__(self, path=None):
+        self.path = path or self._find_path()
+
+    def _find_path(self):
+        home = os.path.expanduser("~")
+        xdg_data_home = os.environ.get("XDG_DATA_HOME", os.path.join(home, ".local", "share"))
+        return os.path.join(xdg_data_home, "infoqscraper", "catalog.sqlite")
+
+    @contextlib.contextmanager
+    def _connect(self, write=False):
+        """Returns a connection to the catalog within a transaction. Changes are committed on exit.
+
+        The presentations table holds the summaries. The presentations_fts table is the full-text
+        index of their title, description and author, its rowids are the presentations ones. The
+        state table holds the high-water mark.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise Error('Failed to create catalog directory %s' % os.path.dirname(self.path))
+
+        try:
+            # Transactions are handled explicitly
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                self._upgrade_schema(conn)
+        except sqlite3.Error as e:
+            raise Error('Failed to open catalog %s: %s' % (self.path, e))
+
+        try:
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _upgrade_schema(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        # Another process may have upgraded the catalog before we got the lock
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._create_schema(conn)
+        if version < 2:
+            conn.execute("CREATE TABLE state (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute("PRAGMA user_version = %d" % _SCHEMA_VERSION)
+        conn.execute("COMMIT")
+
+    def _create_schema(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS presentations (id TEXT PRIMARY KEY, url TEXT NOT NULL, "
+                     "title TEXT NOT NULL, description TEXT NOT NULL, author TEXT NOT NULL, date TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS presentations_date ON presentations (date)")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS presentations_fts USING fts5(title, description, author)")
+        except sqlite3.OperationalError:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS presentations_fts USING fts4(title, description, author)")
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM presentations").fetchone()[0]
+
+    def add(self, summaries):
+        """Adds presentation summaries to the catalog. Known presentations are updated.
+
+        Args:
+            summaries: An iterable of summaries, as generated by scrap.get_summaries
+
+        Returns:
+            The number of presentations not in the catalog yet
+        """
+        count = 0
+        with self._connect(write=True) as conn:
+            for summary in summaries:
+                values = (summary['url'], summary['title'], summary['desc'], summary['auth'],
+                          summary['date'].strftime(_DATE_FORMAT))
+                row = conn.execute("SELECT rowid FROM presentations WHERE id = ?", (summary['id'],)).fetchone()
+                if row:
+                    rowid = row[0]
+                    conn.execute("UPDATE presentations SET url = ?, title = ?, description = ?, author = ?, date = ? "
+                                 "WHERE rowid = ?", values + (rowid,))
+                    conn.execute("DELETE FROM presentations_fts WHERE rowid = ?", (rowid,))
+                else:
+                    rowid = conn.execute("INSERT INTO presentations (id, url, title, description, author, date) "
+                                         "VALUES (?, ?, ?, ?, ?, ?)", (summary['id'],) + values).lastrowid
+                    count += 1
+                conn.execute("INSERT INTO presentations_fts (rowid, title, description, author) VALUES (?, ?, ?, ?)",
+                             (rowid, summary['title'], summary['desc'], summary['auth']))
+        return count
+
+    def high_water_mark(self):
+        """Returns the (id, date) of the newest presentation known along with all the older ones.
+
+        None is returned if the catalog was never updated.
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with self._connect() as conn:
+            state = dict(conn.execute("SELECT name, value FROM state"))
+        if 'newest_id' not in state:
+            return None
+        return state['newest_id'], datetime.datetime.strptime(state['newest_date'], _DATE_FORMAT)
+
+    def update(self, client, max_pages=None, prefetch=4):
+        """Adds the summaries of the listing pages to the catalog, from the newest to the oldest.
+
+        The summaries are written as they are fetched, an interrupted update is not lost.
+
+        Args:
+            client: The web client
+            max_pages: The number of listing pages to fetch, all of them if None
+            prefetch: The number of listing pages fetched ahead
+
+        Returns:
+            The number of presentations added to the catalog
+        """
+        filter = scrap.MaxPagesFilter(max_pages) if max_pages is not None else None
+        return self._add_all(scrap.get_summaries(client, filter=filter, prefetch=prefetch), stop_at_mark=False,
+                             complete=max_pages is None)
+
+    def sync(self, client, prefetch=0):
+        """Adds the presentations published since the high-water mark.
+
+        Paging stops as soon as the high-water mark, or an older presentation, is reached. The
+        whole listing is walked if the catalog has no high-water mark yet.
+
+        Args:
+            client: The web client
+            prefetch: The number of listing pages fetched ahead
+
+        Returns:
+            The number of presentations added to the catalog
+        """
+        return self._add_all(scrap.get_summaries(client, prefetch=prefetch), stop_at_mark=True, complete=True)
+
+    def _add_all(self, summaries, stop_at_mark, complete):
+        """Adds summaries, newest first, then moves the high-water mark to the newest of them.
+
+        The mark only moves if the summaries reached the previous one, or if complete is True and
+        they run to the end of the listing. A bounded walk never sets the mark.
+        """
+        mark = self.high_water_mark()
+        reached = False
+        newest = None
+        count = 0
+        batch = []
+        for summary in summaries:
+            if newest is None:
+                newest = summary
+            if mark is not None and (summary['id'] == mark[0] or summary['date'] < mark[1]):
+                reached = True
+                if stop_at_mark:
+                    break
+            batch.append(summary)
+            if len(batch) >= _BATCH_SIZE:
+                count += self.add(batch)
+                batch = []
+        else:
+            reached = reached or complete
+        count += self.add(batch)
+
+        # Otherwise presentations between the new mark and the previous one would be missing
+        if newest is not None and reached:
+            with self._connect(write=True) as conn:
+                conn.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('newest_id', ?)", (newest['id'],))
+                conn.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('newest_date', ?)",
+                             (newest['date'].strftime(_DATE_FORMAT),))
+        return count
+
+    def search(self, query=None, author=None, since=None, until=None, limit=None):
+        """Searches the catalog, newest presentations first.
+
+        Args:
+            query: Words which must all appear in the title, the description or the author name
+            author: A part of the author name
+            since: A datetime.date, presentations published before are excluded
+            until: A datetime.date, presentations published after are excluded
+            limit: The maximum number of results, unbounded if None
+
+        Returns:
+            A list of summaries, like the ones generated by scrap.get_summaries
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        clauses = []
+        params = []
+        terms = re.findall(r'\w+', query or "", flags=re.UNICODE)
+        if terms:
+            # Each word is quoted, the full-text query syntax is not exposed
+            clauses.append("rowid IN (SELECT rowid FROM presentations_fts WHERE presentations_fts MATCH ?)")
+            params.append(" ".join('"%s"' % term for term in terms))
+        if author:
+            clauses.append("author LIKE ?")
+            params.append("%" + author + "%")
+        if since:
+            clauses.append("date >= ?")
+            params.append(since.strftime(_DATE_FORMAT))
+        if until:
+            clauses.append("date <= ?")
+            params.append(until.strftime(_DATE_FORMAT))
+
+        sql = "SELECT id, url, title, description, author, date FROM presentations"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY date DESC, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        return [{
+            'id':    row[0],
+            'url':   row[1],
+            'title': row[2],
+            'desc':  row[3],
+            'auth':  row[4],
+            'date':  datetime.datetime.strptime(row[5], _DATE_FORMAT),
+        } for row in rows]
@@ -24,7 +24,13 @@
 
 import contextlib
 import os
+import shutil
+import six
+import socket
+import threading
 
+from concurrent import futures
+from six.moves import http_client
 from six.moves import http_cookiejar
 from six.moves import urllib
 
@@ -45,19 +51,42 @@ class InfoQ(object):
     Attributes:
         authenticated:       If logged in or not
         cache:              None if caching is disable. A Cache object otherwise
+        cache_max_size:     Upper bound of the disk cache size in bytes, None if unbounded
+        cache_compression:  Codec used to compress cached pages, None if disabled
+        jobs:               Default number of concurrent downloads used by download_all
+        max_connections_per_host: Upper bound of concurrent requests sent to a single host
+        pool:               The keep-alive connections shared by every request
+        chunk_size:         Number of bytes read at once when a resource is streamed to disk
     """
 
-    def __init__(self, cache_enabled=False):
+    def __init__(self, cache_enabled=False, jobs=1, max_connections_per_host=4, chunk_size=64 * 1024,
+                 cache_max_size=None, cache_compression=None):
         self.authenticated = False
         # InfoQ requires cookies to be logged in. Use a dedicated urllib opener
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http_cookiejar.CookieJar()))
+        # Connections are kept alive to avoid a TCP & TLS handshake per slide
+        self.pool = ConnectionPool(maxsize=max_connections_per_host)
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http_cookiejar.CookieJar()),
+            _KeepAliveHTTPHandler(self.pool),
+            _KeepAliveHTTPSHandler(self.pool),
+        )
+        # Fail now rather than when the cache is enabled
+        cache.check_compression(cache_compression)
         self.cache = None
+        self.cache_max_size = cache_max_size
+        self.cache_compression = cache_compression
         if cache_enabled:
             self.enable_cache()
 
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.max_connections_per_host = max_connections_per_host
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+
     def enable_cache(self):
         if not self.cache:
-            self.cache = cache.XDGCache()
+            self.cache = cache.XDGCache(max_size=self.cache_max_size, compression=self.cache_compression)
 
     def login(self, username, password):
         """ Log in.
@@ -78,64 +107,380 @@ class InfoQ(object):
 
         self.authenticated = True
 
-    def fetch(self, url):
+    def fetch(self, url, max_age=None):
+        """ Fetch the resource specified and return its content, from the cache if enabled.
+
+            Args:
+                url: The url of the resource
+                max_age: Fetch the resource again if cached more than max_age seconds ago.
+                         Cached resources never expire if None.
+        """
         if self.cache:
-            content = self.cache.get_content(url)
+            content = self.cache.get_content(url, max_age)
             if not content:
-                content = self.fetch_no_cache(url)
-                self.cache.put_content(url, content)
+                content = self._fetch_and_put(url, _conditional_headers(*self.cache.get_validators(url)))
+            if content is None:
+                # Not modified, unless evicted in the meantime
+                content = self.cache.refresh(url)
+            if content is None:
+                content = self._fetch_and_put(url)
         else:
             content = self.fetch_no_cache(url)
 
         return content
 
+    def _fetch_and_put(self, url, headers=None):
+        """ Fetch the resource specified, put it in the cache with its validators and return
+            its content. None is returned if the request is conditional and the resource was
+            not modified.
+        """
+        with self._open(url, headers) as response:
+            if response.code == 304:
+                return None
+            content = response.read()
+            info = response.info()
+        self.cache.put_content(url, content, etag=info.get("ETag"), last_modified=info.get("Last-Modified"))
+        return content
+
     def fetch_no_cache(self, url):
         """ Fetch the resource specified and return its content.
 
             DownloadError is raised if the resource cannot be fetched.
         """
-        try:
+        with self._open(url) as response:
+            return response.read()
+
+    def stream(self, url, f):
+        """ Fetch the resource specified and write its content into the file object f,
+            self.chunk_size bytes at a time. The content is never held in memory.
+
+            DownloadError is raised if the resource cannot be fetched.
+        """
+        with self._open(url) as response:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
 
-            with contextlib.closing(self.opener.open(url)) as response:
-                # InfoQ does not send a 404 but a 302 redirecting to a valid URL...
-                if response.code != 200 or response.url == INFOQ_404_URL:
-                    raise DownloadError("%s not found" % url)
-                return response.read()
-        except urllib.error.URLError as e:
+    @contextlib.contextmanager
+    def _open(self, url, headers=None):
+        """ Open the resource specified and return the response once checked.
+
+            If conditional request headers are specified, a 304 response is returned as is.
+
+            DownloadError is raised if the resource cannot be fetched.
+        """
+        request = urllib.request.Request(url, headers=headers or {})
+        try:
+            with self._host_slot(url):
+                try:
+                    response = self.opener.open(request)
+                except urllib.error.HTTPError as e:
+                    if e.code != 304 or not headers:
+                        raise
+                    # urllib reports not modified responses as errors
+                    response = e
+                with contextlib.closing(response):
+                    if response.code == 304:
+                        yield response
+                        return
+                    # InfoQ does not send a 404 but a 302 redirecting to a valid URL...
+                    if response.code != 200 or response.url == INFOQ_404_URL:
+                        raise DownloadError("%s not found" % url)
+                    yield response
+        except (urllib.error.URLError, socket.error, http_client.HTTPException) as e:
             raise DownloadError("Failed to get %s: %s" % (url, e))
 
+    def _host_slot(self, url):
+        """ Return the semaphore bounding the number of concurrent requests to the host of url """
+        host = urllib.parse.urlsplit(url).netloc
+        with self._host_slots_lock:
+            try:
+                return self._host_slots[host]
+            except KeyError:
+                slot = threading.BoundedSemaphore(self.max_connections_per_host)
+                self._host_slots[host] = slot
+                return slot
+
     def download(self, url, dir_path, filename=None):
         """ Download the resources specified by url into dir_path. The resulting
             file path is returned.
 
+            The resource is streamed to disk, then put in the cache if enabled.
+
             DownloadError is raised the resources cannot be downloaded.
         """
         if not filename:
             filename = url.rsplit('/', 1)[1]
         path = os.path.join(dir_path, filename)
 
-        content = self.fetch(url)
-        with open(path, "wb") as f:
-            f.write(content)
+        # The file might be a hard link to a cached resource, never write through it
+        if os.path.exists(path):
+            os.unlink(path)
+
+        cache_path = self.cache.get_path(url) if self.cache else None
+        if cache_path:
+            shutil.copyfile(cache_path, path)
+            return path
+
+        try:
+            with open(path, "wb") as f:
+                self.stream(url, f)
+        except DownloadError:
+            os.unlink(path)
+            raise
+
+        if self.cache:
+            self.cache.put_path(url, path)
 
         return path
 
-    def download_all(self, urls, dir_path):
+    def download_all(self, urls, dir_path, jobs=None):
         """ Download all the resources specified by urls into dir_path. The resulting
-            file paths is returned.
+            file paths is returned in the same order than urls.
+
+            Up to jobs resources are downloaded concurrently, self.jobs if not specified.
 
             DownloadError is raised if at least one of the resources cannot be downloaded.
             In the case already downloaded resources are erased.
         """
-        # TODO: Implement parallel download
+        if jobs is None:
+            jobs = self.jobs
+
+        with futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            fs = [executor.submit(self.download, url, dir_path) for url in urls]
+            # Do not start new downloads once one of them failed
+            futures.wait(fs, return_when=futures.FIRST_EXCEPTION)
+            for f in fs:
+                f.cancel()
+
         filenames = []
+        error = None
+        for f in fs:
+            if f.cancelled():
+                continue
+            if f.exception() is None:
+                filenames.append(f.result())
+            elif error is None:
+                error = f.exception()
 
-        try:
-            for url in urls:
-                filenames.append(self.download(url, dir_path))
-        except DownloadError as e:
+        if error is not None:
             for filename in filenames:
                 os.remove(filename)
-            raise e
+            raise error
 
         return filenames
+
+
+def _conditional_headers(etag, last_modified):
+    """ Return the headers revalidating a resource with the given validators """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+class ConnectionPool(object):
+    """ A pool of keep-alive HTTP connections.
+
+    Idle connections are kept per host and handed over to the next request sent to the same host.
+
+    Attributes:
+        maxsize: Maximum number of idle connections kept per host
+        hits:    Number of requests sent over a reused connection
+        misses:  Number of requests which required a new connection
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """ Number of idle connections currently available """
+        with self._lock:
+            return sum(len(conns) for conns in self._idle.values())
+
+    def acquire(self, scheme, host, timeout):
+        """ Return a (connection, reused) tuple. A new connection is created if none is idle. """
+        with self._lock:
+            conns = self._idle.get((scheme, host))
+            if conns:
+                self.hits += 1
+                return conns.pop(), True
+
+        return self.connect(scheme, host, timeout), False
+
+    def connect(self, scheme, host, timeout):
+        """ Return a new connection, bypassing the idle ones """
+        with self._lock:
+            self.misses += 1
+
+        if scheme == "https":
+            return http_client.HTTPSConnection(host, timeout=timeout)
+        return http_client.HTTPConnection(host, timeout=timeout)
+
+    def release(self, scheme, host, conn):
+        """ Give back a connection whose last response has been fully read """
+        with self._lock:
+            conns = self._idle.setdefault((scheme, host), [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """ Close all the idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class _PooledResponse(object):
+    """ A response which gives its connection back to the pool once closed.
+
+    The connection is only reused if the body has been fully read and the server agreed to keep it open.
+
+    It provides the interface of the responses of urllib, which httplib responses lack on Python 2.
+    """
+
+    def __init__(self, response, url, release, discard):
+        self._response = response
+        self._release = release
+        self._discard = discard
+        self.url = url
+        self.code = response.status
+        self.headers = response.msg
+        self.msg = response.reason
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    if six.PY2:
+        # Required by urllib2.HTTPError, httplib responses cannot read lines on Python 2
+        def readline(self, limit=-1):
+            line = b""
+            while not line.endswith(b"\n") and (limit < 0 or len(line) < limit):
+                char = self._response.read(1)
+                if not char:
+                    break
+                line += char
+            return line
+
+        def readlines(self, hint=-1):
+            return list(iter(self.readline, b""))
+
+    def close(self):
+        if self._release is None:
+            return
+
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        if reusable:
+            self._release()
+        else:
+            self._discard()
+        self._release = self._discard = None
+
+
+def _request_host(req):
+    # urllib2 requests have no host and selector attributes, only accessors
+    return req.host if six.PY3 else req.get_host()
+
+
+def _request_selector(req):
+    return req.selector if six.PY3 else req.get_selector()
+
+
+# Requests which can be sent again if their connection failed
+_IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"])
+
+
+class _KeepAliveHandlerMixin(object):
+    """ Send requests over the connections of a ConnectionPool rather than one connection per request """
+
+    scheme = None
+
+    def _pooled_open(self, req):
+        if getattr(req, "_tunnel_host", None):
+            # Proxy tunnels are not pooled
+            return self.do_open(self.connection_class, req)
+
+        host = _request_host(req)
+        if not host:
+            raise urllib.error.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        method = req.get_method()
+        if method in _IDEMPOTENT_METHODS:
+            conn, reused = self.pool.acquire(self.scheme, host, req.timeout)
+        else:
+            # Never sent twice, an idle connection may have been closed by the server
+            conn, reused = self.pool.connect(self.scheme, host, req.timeout), False
+        try:
+            response = self._send(conn, req, headers)
+        except urllib.error.URLError:
+            if not reused:
+                raise
+            # The server closed the idle connection in the meantime, retry once on a new one
+            conn = self.pool.connect(self.scheme, host, req.timeout)
+            response = self._send(conn, req, headers)
+
+        return _PooledResponse(response, req.get_full_url(),
+                               release=lambda: self.pool.release(self.scheme, host, conn),
+                               discard=conn.close)
+
+    def _send(self, conn, req, headers):
+        try:
+            conn.request(req.get_method(), _request_selector(req), req.data, headers)
+            return conn.getresponse()
+        except (socket.error, http_client.HTTPException) as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+
+
+class _KeepAliveHTTPHandler(_KeepAliveHandlerMixin, urllib.request.HTTPHandler):
+    scheme = "http"
+    connection_class = http_client.HTTPConnection
+
+    def __init__(self, pool):
+        urllib.request.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._pooled_open(req)
+
+
+class _KeepAliveHTTPSHandler(_KeepAliveHandlerMixin, urllib.request.HTTPSHandler):
+    scheme = "https"
+    connection_class = http_client.HTTPSConnection
+
+    def __init__(self, pool):
+        urllib.request.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self._pooled_open(req)
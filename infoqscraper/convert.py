@@ -23,18 +23,50 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import errno
+import json
+import multiprocessing
 import os
 import re
 import shutil
 import six
 import subprocess
+import sys
 import tempfile
 
+from concurrent import futures
+
+from infoqscraper import cache
 from infoqscraper import client
 from infoqscraper import ConversionError
 
 
 class Converter(object):
+    """ Build the video of a presentation.
+
+    Several converters can share the network and the CPU. The network_slot and cpu_slot keyword
+    arguments accept semaphores bounding the number of download stages, and the number of CPU
+    bound processes (swfrender, ffmpeg), running at once across all of them.
+
+    If the pipeline keyword argument is True, the video is downloaded while the slides are
+    downloaded and rendered, each slide being rendered as soon as downloaded.
+
+    If the timeline keyword argument is True, the h264 output type reads the slides through an
+    ffmpeg concat script giving the duration of each slide, rather than through one hard link
+    per second of video. The h264_vfr output type always does, and encodes a variable frame rate
+    slide track holding one frame per slide change. The other output types always use the hard
+    links.
+
+    If the segments keyword argument is greater than 1, the h264 and h264_vfr slide tracks are
+    split at slide changes into that many segments of about the same duration. The segments are
+    encoded by concurrent ffmpeg processes, then joined and muxed with the audio track without
+    being encoded again.
+
+    If the work_dir keyword argument is set, the intermediate files are stored into this directory
+    rather than into a temporary one, and each completed stage (video downloaded, slides fetched,
+    slides rendered, frames prepared) is recorded there. The directory is kept until the
+    presentation is created, so that another attempt skips the completed stages. It is locked
+    while in use, a converter cannot resume the work of another running one.
+    """
 
     def __init__(self, presentation, output, **kwargs):
         self.presentation = presentation
@@ -45,20 +77,50 @@ class Converter(object):
         self.swfrender = kwargs['swfrender']
         self.overwrite = kwargs['overwrite']
         self.type = kwargs['type']
+        self.jobs = kwargs.get('jobs', 1)
+        self.render_jobs = kwargs.get('render_jobs') or multiprocessing.cpu_count()
+        self.network_slot = kwargs.get('network_slot') or _Unbounded()
+        self.cpu_slot = kwargs.get('cpu_slot') or _Unbounded()
+        self.pipeline = kwargs.get('pipeline', False)
+        self.timeline = kwargs.get('timeline', False)
+        self.segments = kwargs.get('segments') or 1
+        self.work_dir = kwargs.get('work_dir')
+        self._completed = False
+        self._locked = False
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        shutil.rmtree(self.tmp_dir)
+        if not hasattr(self, "_tmp_dir"):
+            return
+        if self.work_dir is None or self._completed:
+            shutil.rmtree(self._tmp_dir)
+        elif self._locked:
+            _unlock_work_dir(self.work_dir)
 
     @property
     def tmp_dir(self):
         if not hasattr(self, "_tmp_dir"):
-            self._tmp_dir = tempfile.mkdtemp(prefix="infoq")
+            if self.work_dir is None:
+                self._tmp_dir = tempfile.mkdtemp(prefix="infoq")
+            else:
+                try:
+                    os.makedirs(self.work_dir)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise ConversionError("Failed to create work directory %s" % self.work_dir)
+                if not _lock_work_dir(self.work_dir):
+                    raise ConversionError("Work directory %s is in use by another conversion" % self.work_dir)
+                self._locked = True
+                self._tmp_dir = self.work_dir
 
         return self._tmp_dir
 
+    @property
+    def _checkpoints_path(self):
+        return os.path.join(self.tmp_dir, "checkpoints.json")
+
     @property
     def _audio_path(self):
         return os.path.join(self.tmp_dir, "audio.ogg")
@@ -79,15 +141,62 @@ class Converter(object):
         if not self.overwrite and os.path.exists(self.output):
             raise ConversionError("File %s already exist and --overwrite not specified" % self.output)
 
-        video = self.download_video()
-        raw_slides = self.download_slides()
+        if self.pipeline:
+            video, png_slides = self._checkpoint("pipeline", self._download_and_convert,
+                                                 check=lambda result: _all_exist([result[0]] + result[1]))
+        else:
+            video = self._checkpoint("video", self.download_video, check=os.path.exists)
+            raw_slides = self._checkpoint("slides", self.download_slides, check=_all_exist)
+
+            # ffmpeg does not support SWF
+            png_slides = self._checkpoint("png_slides", lambda: self._convert_slides(raw_slides), check=_all_exist)
+        if self._use_segments:
+            frames = self._checkpoint("segments-%d" % self.segments, lambda: self._prepare_segments(png_slides))
+        elif self._use_timeline:
+            frames = self._checkpoint("timeline", lambda: self._prepare_timeline(png_slides))
+        else:
+            # Create one frame per second using the time code information
+            frames = self._checkpoint("frames", lambda: self._prepare_frames(png_slides))
+
+        result = self._assemble(video, frames)
+        self._completed = True
+        return result
+
+    def _checkpoint(self, stage, build, check=None):
+        """ Run a stage of the conversion, unless a previous attempt completed it.
+
+        Args:
+            stage: The name of the stage
+            build: A function running the stage. Its result must be JSON serializable.
+            check: A function telling whether a recorded result is still valid, e.g. if the
+                video was in the cache and has since been evicted.
+
+        Returns:
+            The result of build, or the one recorded by the previous attempt.
+        """
+        if self.work_dir is None:
+            return build()
+
+        checkpoints = {}
+        if os.path.exists(self._checkpoints_path):
+            with open(self._checkpoints_path) as f:
+                checkpoints = json.load(f)
+        if stage not in checkpoints or (check and not check(checkpoints[stage])):
+            checkpoints[stage] = build()
+            tmp_path = self._checkpoints_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(checkpoints, f)
+            cache.replace_file(tmp_path, self._checkpoints_path)
+
+        return checkpoints[stage]
 
-        # ffmpeg does not support SWF
-        png_slides = self._convert_slides(raw_slides)
-        # Create one frame per second using the time code information
-        frame_pattern = self._prepare_frames(png_slides)
+    @property
+    def _use_timeline(self):
+        return self.type == "h264_vfr" or (self.type == "h264" and (self.timeline or self._use_segments))
 
-        return self._assemble(video, frame_pattern)
+    @property
+    def _use_segments(self):
+        return self.segments > 1 and self.type in ("h264", "h264_vfr")
 
     def download_video(self):
         """Downloads the video.
@@ -100,11 +209,19 @@ class Converter(object):
         Raises:
             DownloadError: If the video cannot be downloaded.
         """
+        with self.network_slot:
+            return self._download_video()
+
+    def _download_video(self):
         rvideo_path = self.presentation.metadata['video_path']
 
         if self.presentation.client.cache:
-            video_path = self.presentation.client.cache.get_path(rvideo_path)
-            if not video_path:
+            cached_path = self.presentation.client.cache.get_path(rvideo_path)
+            if cached_path:
+                # A link of our own, the cached video may be evicted before the conversion ends
+                video_path = self._video_path
+                _link_or_copy(cached_path, video_path)
+            else:
                 video_path = self.download_video_no_cache()
                 self.presentation.client.cache.put_path(rvideo_path, video_path)
         else:
@@ -112,6 +229,42 @@ class Converter(object):
 
         return video_path
 
+    def _download_and_convert(self):
+        """Downloads the video while the slides are downloaded and converted.
+
+        The whole stage takes a single network slot. Each slide is converted as soon as downloaded.
+
+        Returns:
+            A (video path, converted slide paths) tuple
+
+        Raises:
+            DownloadError: If the video or a slide cannot be downloaded.
+            ConversionError: If some slides cannot be converted.
+        """
+        with self.network_slot:
+            # rtmpdump cannot be interrupted, the video download is always waited for
+            with futures.ThreadPoolExecutor(max_workers=1) as executor:
+                video = executor.submit(self._download_video)
+                png_slides = self._download_and_convert_slides()
+                return video.result(), png_slides
+
+    def _download_and_convert_slides(self):
+        client = self.presentation.client
+        urls = self.presentation.metadata['slides']
+        conversions = [None] * len(urls)
+        with futures.ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as downloader:
+            with futures.ThreadPoolExecutor(max_workers=max(self.render_jobs, 1)) as renderer:
+                downloads = dict((downloader.submit(client.download, url, self.tmp_dir), i)
+                                 for i, url in enumerate(urls))
+                for download in futures.as_completed(downloads):
+                    if download.exception() is not None:
+                        for d in downloads:
+                            d.cancel()
+                        raise download.exception()
+                    conversions[downloads[download]] = renderer.submit(self._convert_slide, download.result())
+
+        return self._conversion_results(conversions)
+
     def download_video_no_cache(self):
         """Downloads the video.
 
@@ -151,7 +304,9 @@ class Converter(object):
 
         A DownloadError is raised if at least one of the slides cannot be download..
         """
-        return self.presentation.client.download_all(self.presentation.metadata['slides'], self.tmp_dir)
+        with self.network_slot:
+            return self.presentation.client.download_all(self.presentation.metadata['slides'], self.tmp_dir,
+                                                         jobs=self.jobs)
 
     def _ffmpeg_legacy(self, audio, frame_pattern):
         # Try to be compatible as much as possible with old ffmpeg releases (>= 0.7)
@@ -177,15 +332,60 @@ class Converter(object):
 
         return cmd
 
-    def _ffmpeg_h264(self, audio, frame_pattern):
+    def _ffmpeg_h264(self, audio, frames):
+        if self._use_timeline:
+            # The output keeps the one frame per second of the frame sequence
+            frames_input = ["-f", "concat", "-safe", "0", "-i", frames, "-vf", "fps=1"]
+        else:
+            frames_input = ["-r", "1", "-i", frames]
+
         return [
             self.ffmpeg, "-v", "error",
             "-i", audio,
-            "-r", "1", "-i", frame_pattern,
+        ] + frames_input + [
             "-c:a", "copy",
-            "-c:v", "libx264", "-profile:v", "baseline", "-preset", "ultrafast", "-level", "3.0",
-            "-crf", "28", "-pix_fmt", "yuv420p",
-            "-s", "1280x720",
+        ] + _H264_OPTIONS + [
+            "-y" if self.overwrite else "-n",
+            self.output
+        ]
+
+    def _ffmpeg_h264_vfr(self, audio, timeline):
+        return [
+            self.ffmpeg, "-v", "error",
+            "-i", audio,
+            "-f", "concat", "-safe", "0", "-i", timeline,
+            "-map", "1:v", "-map", "0:a",
+            "-c:a", "copy",
+        ] + _H264_OPTIONS + [
+            # Only emit a frame when the slide changes
+            "-vsync", "vfr",
+            "-y" if self.overwrite else "-n",
+            self.output
+        ]
+
+    def _ffmpeg_segment(self, timeline, duration, path):
+        if self.type == "h264_vfr":
+            rate = ["-vsync", "vfr"]
+        else:
+            rate = ["-vf", "fps=1"]
+
+        # The last slide of a segment is shown until the next segment starts
+        return [
+            self.ffmpeg, "-v", "error",
+            "-f", "concat", "-safe", "0", "-i", timeline,
+        ] + rate + [
+            "-t", str(duration), "-an",
+        ] + _H264_OPTIONS + [
+            "-y", path
+        ]
+
+    def _ffmpeg_join_segments(self, audio, segment_list):
+        return [
+            self.ffmpeg, "-v", "error",
+            "-i", audio,
+            "-f", "concat", "-safe", "0", "-i", segment_list,
+            "-map", "1:v", "-map", "0:a",
+            "-c", "copy",
             "-y" if self.overwrite else "-n",
             self.output
         ]
@@ -271,17 +471,50 @@ class Converter(object):
 
         return cmd
 
-    def _assemble(self, audio, frame_pattern):
+    def _assemble(self, audio, frames):
+        if self._use_segments:
+            return self._assemble_segments(audio, frames)
+
         if self.type == "legacy":
-            cmd = self._ffmpeg_legacy(audio, frame_pattern)
+            cmd = self._ffmpeg_legacy(audio, frames)
         elif self.type == "h264":
-            cmd = self._ffmpeg_h264(audio, frame_pattern)
+            cmd = self._ffmpeg_h264(audio, frames)
+        elif self.type == "h264_vfr":
+            cmd = self._ffmpeg_h264_vfr(audio, frames)
         elif self.type == "h264_overlay":
-            cmd = self._ffmpeg_h264_overlay(audio, frame_pattern)
+            cmd = self._ffmpeg_h264_overlay(audio, frames)
         else:
             raise Exception("Unknown output type %s" % self.type)
 
-        self._run_command(cmd)
+        with self.cpu_slot:
+            self._run_command(cmd)
+
+    def _assemble_segments(self, audio, segments):
+        """ Encode the (timeline, duration) segments concurrently, then join them with the audio track.
+
+            The segments are joined by the concat demuxer, each one starting at the sum of the
+            durations of the previous ones, so that the slides stay in sync with the audio.
+        """
+        with futures.ThreadPoolExecutor(max_workers=max(min(self.render_jobs, len(segments)), 1)) as executor:
+            fs = [executor.submit(self._encode_segment, i, timeline, duration)
+                  for i, (timeline, duration) in enumerate(segments)]
+        paths = [f.result() for f in fs]
+
+        segment_list = os.path.join(self.tmp_dir, "segments.ffconcat")
+        lines = ["ffconcat version 1.0"]
+        for path, (timeline, duration) in zip(paths, segments):
+            lines += ["file %s" % _concat_quote(path), "duration %d" % duration]
+        with open(segment_list, "w") as segment_list_file:
+            segment_list_file.write("\n".join(lines))
+            segment_list_file.write("\n")
+
+        self._run_command(self._ffmpeg_join_segments(audio, segment_list))
+
+    def _encode_segment(self, index, timeline, duration):
+        path = os.path.join(self.tmp_dir, "segment-%03d.mkv" % index)
+        with self.cpu_slot:
+            self._run_command(self._ffmpeg_segment(timeline, duration, path))
+        return path
 
     def _run_command(self, cmd):
         try:
@@ -300,18 +533,42 @@ class Converter(object):
             raise ConversionError(msg)
 
     def _convert_slides(self, slides):
+        """ Convert the SWF slides into PNG images, running up to self.render_jobs swfrender
+            processes at once. The converted slides are returned in order.
+
+            ConversionError is raised if some slides cannot be converted, it reports each of them.
+        """
 
-        def convert(slide):
-            if slide.endswith("swf"):
-                png_slide = slide.replace(".swf", ".png")
+        with futures.ThreadPoolExecutor(max_workers=max(self.render_jobs, 1)) as executor:
+            fs = [executor.submit(self._convert_slide, s) for s in slides]
+
+        return self._conversion_results(fs)
+
+    def _convert_slide(self, slide):
+        if slide.endswith("swf"):
+            png_slide = slide.replace(".swf", ".png")
+            with self.cpu_slot:
                 swf2png(slide, png_slide, swfrender_path=self.swfrender)
-                return png_slide
-            elif slide.endswith("jpg"):
-                return slide
-            else:
-                raise Exception("Unsupported slide type: %s" % slide)
+            return png_slide
+        elif slide.endswith("jpg"):
+            return slide
+        else:
+            raise Exception("Unsupported slide type: %s" % slide)
+
+    def _conversion_results(self, fs):
+        """ Return the results of the slide conversion futures, in order.
+
+            ConversionError is raised if some slides cannot be converted, it reports each of them.
+        """
+        errors = [f.exception() for f in fs if f.exception() is not None]
+        for e in errors:
+            if not isinstance(e, ConversionError):
+                raise e
+        if errors:
+            raise ConversionError("Failed to convert %d of %d slides:\n%s"
+                                  % (len(errors), len(fs), "\n".join(str(e) for e in errors)))
 
-        return [convert(s) for s in slides]
+        return [f.result() for f in fs]
 
     def _prepare_frames(self, slides):
         timecodes = self.presentation.metadata['timecodes']
@@ -321,6 +578,9 @@ class Converter(object):
         for slide_index, src in enumerate(slides):
             for remaining in range(timecodes[slide_index], timecodes[slide_index+1]):
                 dst = os.path.join(self.tmp_dir, "frame-{0:04d}." + ext).format(frame)
+                # Left by an interrupted attempt
+                if os.path.lexists(dst):
+                    os.unlink(dst)
                 try:
                     os.link(src, dst)
                 except OSError as e:
@@ -336,6 +596,223 @@ class Converter(object):
 
         return os.path.join(self.tmp_dir, "frame-%04d." + ext)
 
+    def _prepare_timeline(self, slides):
+        """ Write an ffmpeg concat script showing each slide for the time given by the time codes.
+
+            The path of the script is returned.
+        """
+        timeline_path = os.path.join(self.tmp_dir, "timeline.ffconcat")
+        self._write_timeline(timeline_path, self._timeline_entries(slides))
+
+        return timeline_path
+
+    def _prepare_segments(self, slides):
+        """ Split the slides at slide changes into up to self.segments concat scripts of about the
+            same duration.
+
+            A list of (script path, duration) tuples is returned.
+        """
+        entries = self._timeline_entries(slides)
+        total = sum(duration for src, duration in entries)
+
+        groups = []
+        group = []
+        elapsed = 0
+        for src, duration in entries:
+            group.append((src, duration))
+            elapsed += duration
+            if elapsed * self.segments >= total * (len(groups) + 1):
+                groups.append(group)
+                group = []
+        if group:
+            groups.append(group)
+
+        segments = []
+        for i, group in enumerate(groups):
+            timeline_path = os.path.join(self.tmp_dir, "segment-%03d.ffconcat" % i)
+            self._write_timeline(timeline_path, group)
+            segments.append((timeline_path, sum(duration for src, duration in group)))
+
+        return segments
+
+    def _timeline_entries(self, slides):
+        """ The (slide, duration) pairs given by the time codes, slides never shown are skipped """
+        timecodes = self.presentation.metadata['timecodes']
+
+        entries = []
+        for slide_index, src in enumerate(slides):
+            duration = timecodes[slide_index+1] - timecodes[slide_index]
+            if duration > 0:
+                entries.append((src, duration))
+
+        return entries
+
+    def _write_timeline(self, path, entries):
+        lines = ["ffconcat version 1.0"]
+        for src, duration in entries:
+            lines += ["file %s" % _concat_quote(src), "duration %d" % duration]
+        # The duration of the last entry is only honored when followed by another file
+        if entries:
+            lines.append("file %s" % _concat_quote(entries[-1][0]))
+
+        with open(path, "w") as timeline_file:
+            timeline_file.write("\n".join(lines))
+            timeline_file.write("\n")
+
+
+# libx264 settings of the h264 output types
+_H264_OPTIONS = [
+    "-c:v", "libx264", "-profile:v", "baseline", "-preset", "ultrafast", "-level", "3.0",
+    "-crf", "28", "-pix_fmt", "yuv420p",
+    "-s", "1280x720",
+]
+
+
+def _all_exist(paths):
+    return all(os.path.exists(path) for path in paths)
+
+
+def _link_or_copy(src, dst):
+    """ Hard link src to dst, or copy it if links are not supported. Replace dst if any. """
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        # No hard links on Windows with Python 2, nor across file systems
+        shutil.copyfile(src, dst)
+
+
+def _concat_quote(path):
+    """ Quote a path for an ffmpeg concat script """
+    return "'%s'" % path.replace("'", "'\\''")
+
+
+class _Unbounded(object):
+    """ A semaphore which never blocks """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+def find_work_root():
+    """ Returns the directory of the work directories, in the XDG_CACHE_HOME directory """
+    return os.path.join(cache.find_cache_dir(), "work")
+
+
+def find_work_dir(id):
+    """ Returns the work directory of the presentation id, in the XDG_CACHE_HOME directory """
+    return os.path.join(find_work_root(), id)
+
+
+def work_dirs_size():
+    """ Returns the size in bytes of the work directories left by unfinished conversions """
+    size = 0
+    for dir_path, dir_names, filenames in os.walk(find_work_root()):
+        for f in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, f))
+            except OSError:
+                # Removed meanwhile by its converter
+                pass
+    return size
+
+
+def remove_work_dir(work_dir):
+    """ Deletes a work directory, unless in use by a running conversion.
+
+    Returns:
+        The number of bytes freed
+
+    Raises:
+        ConversionError: If the work directory is in use
+    """
+    if not os.path.isdir(work_dir):
+        return 0
+    if not _lock_work_dir(work_dir):
+        raise ConversionError("Work directory %s is in use by another conversion" % work_dir)
+
+    size = 0
+    for dir_path, dir_names, filenames in os.walk(work_dir):
+        size += sum(os.path.getsize(os.path.join(dir_path, f)) for f in filenames if f != "lock")
+    shutil.rmtree(work_dir)
+    return size
+
+
+def clear_work_dirs():
+    """ Deletes the work directories left by unfinished conversions, except the ones in use.
+
+    Returns:
+        The number of bytes freed
+    """
+    root = find_work_root()
+    if not os.path.isdir(root):
+        return 0
+
+    freed = 0
+    for name in os.listdir(root):
+        try:
+            freed += remove_work_dir(os.path.join(root, name))
+        except ConversionError:
+            pass
+    return freed
+
+
+def _lock_work_dir(work_dir):
+    """ Takes the lock of a work directory, a file holding the pid of its owner.
+
+    A lock left by a process which no longer runs is taken over.
+
+    Returns:
+        False if the lock is held by a running process, this one included
+    """
+    path = os.path.join(work_dir, "lock")
+    for attempt in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if _lock_owner_runs(path):
+                return False
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(str(os.getpid()))
+        return True
+    return False
+
+
+def _unlock_work_dir(work_dir):
+    try:
+        os.unlink(os.path.join(work_dir, "lock"))
+    except OSError:
+        pass
+
+
+def _lock_owner_runs(path):
+    try:
+        with open(path) as f:
+            pid = int(f.read())
+    except (IOError, OSError, ValueError):
+        # Being written by its owner, or removed meanwhile
+        return True
+
+    # os.kill terminates the process on Windows, whatever the signal
+    if sys.platform.startswith("win32"):
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
 
 def swf2png(swf_path, png_path, swfrender_path="swfrender"):
     """Convert SWF slides into a PNG image
@@ -22,13 +22,21 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import argparse
+import collections
+import datetime
+import multiprocessing
 import os
 import pkg_resources
 import re
 import six
 import subprocess
 import sys
+import threading
+import traceback
 
+from concurrent import futures
+from infoqscraper import cache
+from infoqscraper import catalog
 from infoqscraper import client
 from infoqscraper import convert
 from infoqscraper import scrap
@@ -101,6 +109,8 @@ class CacheModule(Module):
         self.commands = {
             CacheModule.Size.name: CacheModule.Size,
             CacheModule.Clear.name: CacheModule.Clear,
+            CacheModule.Prune.name: CacheModule.Prune,
+            CacheModule.Migrate.name: CacheModule.Migrate,
             }
 
     def main(self, infoq_client, args):
@@ -118,7 +128,7 @@ class CacheModule(Module):
         return command.main(infoq_client, args.command_args)
 
     class Clear(Command):
-        """Clears the cache."""
+        """Clears the cache, and the work directories of unfinished downloads."""
         name = "clear"
 
         def main(self, infoq_client, args):
@@ -128,39 +138,142 @@ class CacheModule(Module):
             infoq_client.enable_cache()
             try:
                 infoq_client.cache.clear()
+                convert.clear_work_dirs()
             except OSError as e:
                 raise CommandError("Failed to clean the disk cache: %s" % e, 3)
 
             return 0
 
     class Size(Command):
-        """Gives information about the disk cache"""
+        """Gives the size of the disk cache, work directories of unfinished downloads included"""
         name = "size"
 
         def main(self, infoq_client, args):
             parser = argparse.ArgumentParser(prog="%s %s %s" % (app_name, CacheModule.name, CacheModule.Size.name))
+            parser.add_argument('--verify', action="store_true",
+                                help='walk the whole cache rather than trusting its index (slow)')
             args = parser.parse_args(args=args)
 
             infoq_client.enable_cache()
-            size = infoq_client.cache.size
-            human_size = self.__humanize(size, 2)
+            if args.verify:
+                size = infoq_client.cache.verify_size()
+            else:
+                size = infoq_client.cache.size
+            size += convert.work_dirs_size()
+            human_size = humanize_size(size, 2)
             print("%s" % human_size)
 
-        def __humanize(self, bytes, precision=2):
-            suffixes = (
-                (1 << 50, 'PB'),
-                (1 << 40, 'TB'),
-                (1 << 30, 'GB'),
-                (1 << 20, 'MB'),
-                (1 << 10, 'kB'),
-                (1, 'bytes')
-            )
-            if bytes == 1:
-                return '1 byte'
-            for factor, suffix in suffixes:
-                if bytes >= factor:
-                    break
-            return '%.*f %s' % (precision, bytes / factor, suffix)
+    class Prune(Command):
+        """Evicts least recently used resources until the cache fits in a given size
+
+        The work directories of unfinished downloads are deleted first.
+        """
+        name = "prune"
+
+        def main(self, infoq_client, args):
+            parser = argparse.ArgumentParser(prog="%s %s %s" % (app_name, CacheModule.name, CacheModule.Prune.name))
+            parser.add_argument('-m', '--max-size', type=parse_size, default=None,
+                                help='size to reach, e.g. 500M or 20G (default: --cache-max-size)')
+            args = parser.parse_args(args=args)
+
+            infoq_client.enable_cache()
+            try:
+                freed = convert.clear_work_dirs() + infoq_client.cache.prune(args.max_size)
+            except ValueError:
+                raise ArgumentError("No size specified. Use --max-size or %s --cache-max-size" % app_name)
+            except OSError as e:
+                raise CommandError("Failed to prune the disk cache: %s" % e, 3)
+
+            print("%s freed" % humanize_size(freed, 2))
+            return 0
+
+
+    class Migrate(Command):
+        """Converts a cache created by a previous release to the current layout"""
+        name = "migrate"
+
+        def main(self, infoq_client, args):
+            parser = argparse.ArgumentParser(prog="%s %s %s" % (app_name, CacheModule.name, CacheModule.Migrate.name))
+            args = parser.parse_args(args=args)
+
+            infoq_client.enable_cache()
+            try:
+                count = infoq_client.cache.migrate()
+            except (OSError, cache.Error) as e:
+                raise CommandError("Failed to migrate the disk cache: %s" % e, 3)
+
+            print("%d files migrated" % count)
+            return 0
+
+
+class CatalogModule(Module):
+    """All commands related to the local catalog of presentations go here.
+
+    New commands must be registered into the commands attribute.
+
+    Attributes:
+        commands: A dictionary of available commands. Keys are command names. Value are commands.
+    """
+    name = "catalog"
+
+    def __init__(self):
+        self.commands = {
+            CatalogModule.Update.name: CatalogModule.Update,
+            CatalogModule.Sync.name: CatalogModule.Sync,
+            }
+
+    def main(self, infoq_client, args):
+        parser = argparse.ArgumentParser(prog="%s %s" % (app_name, self.name))
+        parser.add_argument('command', choices = list(self.commands.keys()))
+        parser.add_argument('command_args', nargs=argparse.REMAINDER)
+        args = parser.parse_args(args=args)
+
+        try:
+            command_class = self.commands[args.command]
+        except KeyError:
+            raise ArgumentError("%s is not a %s %s command" % (args.command, app_name, self.name))
+
+        command = command_class()
+        return command.main(infoq_client, args.command_args)
+
+    class Update(Command):
+        """Adds the summaries of all the listing pages to the catalog"""
+        name = "update"
+
+        def main(self, infoq_client, args):
+            parser = argparse.ArgumentParser(prog="%s %s %s" % (app_name, CatalogModule.name, CatalogModule.Update.name))
+            parser.add_argument('-m', '--max-pages', type=int, default=None, help='maximum number of pages to fetch (default: all)')
+            parser.add_argument('-P', '--prefetch',  type=int, default=4,    help='number of pages fetched ahead')
+            args = parser.parse_args(args=args)
+
+            try:
+                count = catalog.Catalog().update(infoq_client, max_pages=args.max_pages, prefetch=args.prefetch)
+            except catalog.Error as e:
+                raise CommandError("Failed to update the catalog: %s" % e, 3)
+            except DownloadError as e:
+                raise CommandError("Failed to fetch the listing pages: %s" % e, 2)
+
+            print("%d presentations added" % count)
+            return 0
+
+    class Sync(Command):
+        """Adds the presentations published since the last update or sync to the catalog"""
+        name = "sync"
+
+        def main(self, infoq_client, args):
+            parser = argparse.ArgumentParser(prog="%s %s %s" % (app_name, CatalogModule.name, CatalogModule.Sync.name))
+            parser.add_argument('-P', '--prefetch', type=int, default=0, help='number of pages fetched ahead')
+            args = parser.parse_args(args=args)
+
+            try:
+                count = catalog.Catalog().sync(infoq_client, prefetch=args.prefetch)
+            except catalog.Error as e:
+                raise CommandError("Failed to sync the catalog: %s" % e, 3)
+            except DownloadError as e:
+                raise CommandError("Failed to fetch the listing pages: %s" % e, 2)
+
+            print("%d presentations added" % count)
+            return 0
 
 
 class PresentationModule(Module):
@@ -176,6 +289,7 @@ class PresentationModule(Module):
     def __init__(self):
         self.commands = {
             PresentationModule.PresentationList.name: PresentationModule.PresentationList,
+            PresentationModule.PresentationSearch.name: PresentationModule.PresentationSearch,
             PresentationModule.PresentationDownload.name: PresentationModule.PresentationDownload,
         }
 
@@ -245,36 +359,47 @@ class PresentationModule(Module):
             parser.add_argument('-n', '--max-hits',  type=int, default=10,   help='maximum number of hits')
             parser.add_argument('-p', '--pattern',   type=str, default=None, help='filter hits according to this pattern')
             parser.add_argument('-s', '--short',     action="store_true",    help='short output, only ids are displayed')
+            parser.add_argument('-P', '--prefetch',  type=int, default=0,    help='number of pages fetched ahead')
             args = parser.parse_args(args=args)
 
             filter = PresentationModule.PresentationList._Filter(pattern=args.pattern, max_hits=args.max_hits, max_pages=args.max_pages)
-            summaries = scrap.get_summaries(infoq_client, filter=filter)
-            if args.short:
-                self.__short_output(summaries)
-            else:
-                self.__standard_output(summaries)
-
+            summaries = scrap.get_summaries(infoq_client, filter=filter, prefetch=args.prefetch)
+            print_summaries(summaries, short=args.short)
             return 0
 
-        def __standard_output(self, results):
-            from textwrap import fill
+    class PresentationSearch(Command):
+        """Search the presentations of the local catalog"""
+        name = "search"
+
+        def main(self, infoq_client, args):
+            parser = argparse.ArgumentParser(prog="%s %s %s" % (app_name, PresentationModule.name, PresentationModule.PresentationSearch.name))
+            parser.add_argument('-a', '--author',   type=str, default=None, help='part of the author name')
+            parser.add_argument('--since',          type=parse_date, default=None, help='oldest publication date, YYYY-MM-DD')
+            parser.add_argument('--until',          type=parse_date, default=None, help='newest publication date, YYYY-MM-DD')
+            parser.add_argument('-n', '--max-hits', type=int, default=10,   help='maximum number of hits')
+            parser.add_argument('-s', '--short',    action="store_true",    help='short output, only ids are displayed')
+            parser.add_argument('words', nargs='*', help='words of the title, description or author')
+            args = parser.parse_args(args=args)
+
+            c = catalog.Catalog()
+            try:
+                if not len(c):
+                    return warn("The catalog is empty. Run '%s %s %s' first" % (app_name, CatalogModule.name, CatalogModule.Update.name))
 
-            index = 0
-            for result in results:
-                tab = ' ' * 8
-                date = result['date'].strftime("%Y-%m-%d")
-                print(six.u(""))
-                print(six.u("{0:>3}. Title: {1} ({2})").format(index, result['title'], date))
-                print(six.u("     Id: {0}").format(result['id']))
-                print(six.u("     Desc: \n{0}{1}").format(tab, fill(result['desc'], width=80, subsequent_indent=tab)))
-                index += 1
+                summaries = c.search(" ".join(args.words), author=args.author, since=args.since, until=args.until,
+                                     limit=args.max_hits)
+            except catalog.Error as e:
+                raise CommandError("Failed to search the catalog: %s" % e, 3)
 
-        def __short_output(self, results):
-            for result in results:
-                print(result['id'])
+            print_summaries(summaries, short=args.short)
+            return 0
 
     class PresentationDownload(Command):
-        """Download a presentation"""
+        """Download one or several presentations
+
+        Several presentations are processed by a pool of workers sharing the web client. The
+        download stages and the CPU bound stages (swfrender, ffmpeg) have separate limits.
+        """
         name = "download"
 
         def main(self, infoq_client, args):
@@ -285,35 +410,112 @@ class PresentationModule(Module):
             parser.add_argument('-o', '--output',    nargs="?", type=str, help='output file')
             parser.add_argument('-y', '--overwrite', action="store_true", help='Overwrite existing video files')
             parser.add_argument('-t', '--type',      nargs="?", type=str, default="legacy",
-                                help='output type: legacy, h264, h264_overlay')
-            parser.add_argument('identifier', help='name of the presentation or url')
+                                help='output type: legacy, h264, h264_vfr, h264_overlay')
+            parser.add_argument('-j', '--jobs',      type=int, default=4,
+                                help='number of slides downloaded concurrently')
+            parser.add_argument('--network-jobs',    type=int, default=2,
+                                help='number of presentations downloaded concurrently')
+            parser.add_argument('--cpu-jobs',        type=int, default=multiprocessing.cpu_count(),
+                                help='number of swfrender and ffmpeg processes run concurrently')
+            parser.add_argument('-p', '--pipeline',  action="store_true",
+                                help='download the video while the slides are downloaded and rendered')
+            parser.add_argument('--timeline',        action="store_true",
+                                help='h264 only, give ffmpeg the duration of each slide rather than one frame per second')
+            parser.add_argument('--segments',        type=int, default=1,
+                                help='h264 and h264_vfr only, number of slide track segments encoded concurrently')
+            parser.add_argument('--restart',         action="store_true",
+                                help='discard the work of previous failed attempts rather than resuming it')
+            parser.add_argument('-i', '--input',     type=argparse.FileType('r'), default=None,
+                                help="file of presentation names or urls, one per line, '-' for stdin "
+                                     "(e.g. the output of list --short)")
+            parser.add_argument('identifiers', nargs='*', metavar='identifier', help='name of the presentation or url')
             args = parser.parse_args(args)
 
+            identifiers = list(args.identifiers)
+            if args.input:
+                try:
+                    identifiers += [line.strip() for line in args.input if line.strip() and not line.startswith('#')]
+                finally:
+                    if args.input is not sys.stdin:
+                        args.input.close()
+            # A name and its url must not be converted twice, concurrently
+            unique = collections.OrderedDict()
+            for identifier in identifiers:
+                unique.setdefault(self.__extract_id(identifier), identifier)
+            identifiers = list(unique.values())
+            if not identifiers:
+                parser.error("no presentation specified")
+            if args.output and len(identifiers) > 1:
+                raise ArgumentError("--output cannot be used with several presentations")
+
             # Check required tools are available before doing any useful work
             self.__check_dependencies([args.ffmpeg, args.swfrender, args.rtmpdump])
 
-            # Process arguments
-            id = self.__extract_id(args.identifier)
-            output = self.__chose_output(args.output, id)
+            if args.restart:
+                for identifier in identifiers:
+                    try:
+                        convert.remove_work_dir(convert.find_work_dir(self.__extract_id(identifier)))
+                    except (OSError, ConversionError) as e:
+                        raise CommandError("Failed to restart %s: %s" % (identifier, e), 2)
+
+            kwargs = {
+                "ffmpeg":       args.ffmpeg,
+                "rtmpdump":     args.rtmpdump,
+                "swfrender":    args.swfrender,
+                "overwrite":    args.overwrite,
+                "type":         args.type,
+                "jobs":         args.jobs,
+                "render_jobs":  args.cpu_jobs,
+                "network_slot": threading.BoundedSemaphore(max(args.network_jobs, 1)),
+                "cpu_slot":     threading.BoundedSemaphore(max(args.cpu_jobs, 1)),
+                "pipeline":     args.pipeline,
+                "timeline":     args.timeline,
+                "segments":     args.segments,
+            }
+
+            if len(identifiers) == 1:
+                return self.__download(infoq_client, identifiers[0], args.output, kwargs)
+
+            # Enough workers to keep both the network and the CPUs busy
+            workers = max(args.network_jobs, 1) + max(args.cpu_jobs, 1)
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                codes = list(executor.map(lambda i: self.__download_in_batch(infoq_client, i, kwargs), identifiers))
+
+            failed = len([code for code in codes if code])
+            if failed:
+                return warn("%d of %d presentations failed" % (failed, len(identifiers)), 2)
+            return 0
+
+        def __download_in_batch(self, infoq_client, identifier, kwargs):
+            """Create the video of a presentation of a batch. Returns the exit code.
+
+            Unexpected errors are reported with their traceback as failures of the presentation,
+            so that they do not abort the other presentations.
+            """
+            try:
+                return self.__download(infoq_client, identifier, None, kwargs)
+            except Exception:
+                return warn("Failed to create presentation %s:\n%s" % (identifier, traceback.format_exc()), 2)
+
+        def __download(self, infoq_client, identifier, output, kwargs):
+            """Create the video of a presentation. Returns the exit code."""
+            id = self.__extract_id(identifier)
+            output = self.__chose_output(output, id, kwargs["type"])
 
             try:
                 pres = scrap.Presentation(infoq_client, id)
             except client.DownloadError as e:
                 return warn("Presentation %s not found. Please check your id or url" % id, 2)
 
-            kwargs = {
-                "ffmpeg":    args.ffmpeg,
-                "rtmpdump":  args.rtmpdump,
-                "swfrender": args.swfrender,
-                "overwrite": args.overwrite,
-                "type":      args.type,
-            }
-
-            with convert.Converter(pres, output, **kwargs) as builder:
-                try:
+            # Resume from the stages completed by a previous attempt
+            work_dir = convert.find_work_dir(id)
+            try:
+                with convert.Converter(pres, output, work_dir=work_dir, **kwargs) as builder:
                     builder.create_presentation()
-                except (DownloadError, ConversionError) as e:
-                    return warn("Failed to create presentation %s: %s" % (output, e), 2)
+            except (DownloadError, ConversionError) as e:
+                return warn("Failed to create presentation %s: %s" % (output, e), 2)
+
+            return 0
 
         def __check_dependencies(self, dependencies):
             for cmd in dependencies:
@@ -330,13 +532,71 @@ class PresentationModule(Module):
 
             return name
 
-        def __chose_output(self, output, id):
+        def __chose_output(self, output, id, type):
             if output:
                 return output
 
+            # AVI cannot hold a variable frame rate
+            if type == "h264_vfr":
+                return "%s.mkv" % id
+
             return "%s.avi" % id
 
 
+def print_summaries(summaries, short=False):
+    """Prints presentation summaries, only their ids if short"""
+    if short:
+        for summary in summaries:
+            print(summary['id'])
+        return
+
+    from textwrap import fill
+
+    index = 0
+    for result in summaries:
+        tab = ' ' * 8
+        date = result['date'].strftime("%Y-%m-%d")
+        print(six.u(""))
+        print(six.u("{0:>3}. Title: {1} ({2})").format(index, result['title'], date))
+        print(six.u("     Id: {0}").format(result['id']))
+        print(six.u("     Desc: \n{0}{1}").format(tab, fill(result['desc'], width=80, subsequent_indent=tab)))
+        index += 1
+
+
+def humanize_size(bytes, precision=2):
+    suffixes = (
+        (1 << 50, 'PB'),
+        (1 << 40, 'TB'),
+        (1 << 30, 'GB'),
+        (1 << 20, 'MB'),
+        (1 << 10, 'kB'),
+        (1, 'bytes')
+    )
+    if bytes == 1:
+        return '1 byte'
+    for factor, suffix in suffixes:
+        if bytes >= factor:
+            break
+    return '%.*f %s' % (precision, bytes / factor, suffix)
+
+
+def parse_size(str):
+    """Parses a size like 1024, 500k, 500M or 20G into a number of bytes."""
+    units = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    mo = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', str, flags=re.I)
+    if not mo:
+        raise argparse.ArgumentTypeError("invalid size: %s" % str)
+    return int(float(mo.group(1)) * units[mo.group(2).lower()])
+
+
+def parse_date(str):
+    """Parses a YYYY-MM-DD date."""
+    try:
+        return datetime.datetime.strptime(str, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: %s" % str)
+
+
 def warn(str, code=1):
     six.print_(str, file=sys.stderr)
     return code
@@ -351,18 +611,27 @@ def main():
 
     modules = {
         PresentationModule.name: PresentationModule,
-        CacheModule.name: CacheModule
+        CacheModule.name: CacheModule,
+        CatalogModule.name: CatalogModule,
     }
 
     parser = argparse.ArgumentParser(prog="infoqscraper")
     parser.add_argument('-c', '--cache'    , action="store_true", help="Enable disk caching.")
+    parser.add_argument('--cache-max-size' , type=parse_size, default=None,
+                        help="Bound the disk cache size, e.g. 20G. Least recently used resources are evicted.")
+    parser.add_argument('--cache-compression', choices=["zlib", "zstd"], default=None,
+                        help="Compress cached pages. zstd requires the zstandard module.")
     parser.add_argument('-V', '--version'  , action="version",    help="Display version",
                         version="%s %s" % (app_name, app_version))
     parser.add_argument('module', choices=list(modules.keys()))
     parser.add_argument('module_args', nargs=argparse.REMAINDER)
     args = parser.parse_args()
 
-    infoq_client = client.InfoQ(cache_enabled=args.cache)
+    try:
+        infoq_client = client.InfoQ(cache_enabled=args.cache, cache_max_size=args.cache_max_size,
+                                    cache_compression=args.cache_compression)
+    except ValueError as e:
+        return warn("%s: %s" % (app_name, e), 2)
 
     try:
         module_class = modules[args.module]
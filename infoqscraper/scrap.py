@@ -24,35 +24,130 @@
 
 import base64
 import bs4
+import collections
 import datetime
+import hashlib
 import re
 
+from concurrent import futures
+
 from infoqscraper import client
 
 import six
 from six.moves import urllib
 
+# lxml is a C parser, much faster than the pure Python html.parser. Any parser supported by
+# BeautifulSoup can be given to the scraping functions, like "html5lib".
+try:
+    import lxml
+    DEFAULT_PARSER = "lxml"
+except ImportError:
+    DEFAULT_PARSER = "html.parser"
+
+# How long cached pages are trusted, in seconds. Listing pages change whenever a presentation
+# is published, presentation pages hardly ever change.
+LISTING_MAX_AGE = 60 * 60
+PRESENTATION_MAX_AGE = 30 * 24 * 60 * 60
+
+# Version of the metadata extraction. Bump it whenever the extracted metadata change, so that
+# the metadata cached by previous versions are extracted again.
+METADATA_VERSION = 1
+
+# How datetime values of cached metadata are serialized
+_METADATA_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Patterns of the metadata embedded in the scripts of a presentation page
+_TIMECODES_RE = re.compile(r"TIMES\s?=\s?new\s+Array.?\((\d+(,\d+)+)\)")
+_SLIDES_RE = re.compile(r"var\s+slides\s?=\s?new\s+Array.?\(('.+')\)")
+_VIDEO_RE = re.compile(r"var jsclassref = '(.*)';")
+_DEMO_TIMINGS_RE = re.compile(r"demoTimings\s+=\s+'([^']+)")
 
-def get_summaries(client, filter=None):
+# Only the summaries of a listing page are built into a tree, the rest of the page is skipped
+_SUMMARIES_STRAINER = bs4.SoupStrainer('div', class_='news_type_video')
+
+
+def get_summaries(client, filter=None, parser=None, prefetch=0):
     """ Generate presentation summaries in a reverse chronological order.
 
      A filter class can be supplied to filter summaries or bound the fetching process.
+     The pages are parsed with the specified BeautifulSoup parser, DEFAULT_PARSER if not specified.
+
+     If prefetch is positive, up to prefetch next listing pages are fetched concurrently while
+     the summaries of the current page are consumed. Listing pages are expected to have the same
+     size. The max_pages attribute of the filter, if any, bounds the prefetched pages.
     """
-    try:
-        index = 0
-        while True:
-            rb = _RightBarPage(client, index)
+    if prefetch > 0:
+        pages = _prefetched_pages(client, parser, prefetch, getattr(filter, "max_pages", None))
+    else:
+        pages = _pages(client, parser)
 
-            summaries = rb.summaries()
+    try:
+        for summaries in pages:
             if filter is not None:
                 summaries = filter.filter(summaries)
 
             for summary in summaries:
                     yield summary
-
-            index += len(summaries)
     except StopIteration:
         pass
+    finally:
+        pages.close()
+
+
+def _pages(client, parser):
+    """ Generate the summaries of each listing page, one page after the other """
+    index = 0
+    while True:
+        summaries = _RightBarPage(client, index, parser=parser).summaries()
+        if not summaries:
+            return
+
+        yield summaries
+        index += len(summaries)
+
+
+def _prefetched_pages(client, parser, prefetch, max_pages=None):
+    """ Generate the summaries of each listing page, fetching the next pages concurrently
+
+    Args:
+        prefetch: The number of pages fetched ahead
+        max_pages: The number of pages to generate, unbounded if None
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=prefetch)
+    pending = collections.deque()  # (index, future) of the prefetched pages, in order
+    try:
+        index = 0
+        summaries = _RightBarPage(client, index, parser=parser).summaries()
+        page_count = 1
+        next_index = index
+        while summaries:
+            expected_index = index + len(summaries)
+            if pending and pending[0][0] != expected_index:
+                # The page size changed, the prefetched pages do not follow this one
+                _cancel(pending)
+            if not pending:
+                next_index = expected_index
+            while len(pending) < prefetch and (max_pages is None or page_count + len(pending) < max_pages):
+                page = _RightBarPage(client, next_index, parser=parser)
+                pending.append((next_index, executor.submit(page.summaries)))
+                next_index += len(summaries)
+
+            yield summaries
+
+            if not pending:
+                return
+            index, future = pending.popleft()
+            summaries = future.result()
+            page_count += 1
+    finally:
+        _cancel(pending)
+        executor.shutdown(wait=False)
+
+
+def _cancel(pending):
+    for _, future in pending:
+        future.cancel()
+    pending.clear()
 
 
 class MaxPagesFilter(object):
@@ -73,17 +168,48 @@ class MaxPagesFilter(object):
 class Presentation(object):
     """ An InfoQ presentation.
 
+    If the client cache is enabled, the metadata extracted from the presentation page are cached
+    along with the digest of the page. The page is not parsed again until it changes.
     """
-    def __init__(self, client, id):
+    def __init__(self, client, id, content=None, parser=None):
+        """
+        Args:
+            client: The web client
+            id: The presentation id
+            content: The already fetched presentation page. Downloaded if not specified.
+            parser: The BeautifulSoup parser of the page, DEFAULT_PARSER if not specified
+        """
         self.client = client
         self.id = id
-        self.soup = self._fetch()
+        self.parser = parser or DEFAULT_PARSER
+        if content is None:
+            content = self._fetch()
+        self._content = content
+        self._digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+        if self.client.cache:
+            metadata = self.client.cache.get_metadata(self.id, self._digest, METADATA_VERSION)
+            if metadata is not None:
+                self._metadata = _decode_metadata(metadata)
 
     def _fetch(self):
-        """Download the page and create the soup"""
+        """Download the page
+
+        The page is only cached for anonymous clients, its markup is not the same if authenticated.
+        """
         url = client.get_url("/presentations/" + self.id)
-        content = self.client.fetch_no_cache(url).decode('utf-8')
-        return bs4.BeautifulSoup(content, "html.parser")
+        if self.client.authenticated:
+            return self.client.fetch_no_cache(url).decode('utf-8')
+        return self.client.fetch(url, max_age=PRESENTATION_MAX_AGE).decode('utf-8')
+
+    @property
+    def soup(self):
+        """Create the soup of the page, on first use"""
+        try:
+            return self._soup
+        except AttributeError:
+            self._soup = bs4.BeautifulSoup(self._content, self.parser)
+            return self._soup
 
     @property
     def metadata(self):
@@ -101,32 +227,26 @@ class Presentation(object):
         def get_author(pres_div):
             return pres_div.find('span', class_='authors-list').find('a').get_text().strip()
 
-        def get_timecodes(pres_div):
-            for script in pres_div.find_all('script'):
-                mo = re.search("TIMES\s?=\s?new\s+Array.?\((\d+(,\d+)+)\)", script.get_text())
-                if mo:
-                    return [int(tc) for tc in mo.group(1).split(',')]
-
-        def get_slides(pres_div):
-            for script in pres_div.find_all('script'):
-                mo = re.search("var\s+slides\s?=\s?new\s+Array.?\(('.+')\)", script.get_text())
-                if mo:
-                    return [slide.replace('\'', '') for slide in  mo.group(1).split(',')]
-
-        def get_video(pres_div):
-            for script in pres_div.find_all('script'):
-                mo = re.search('var jsclassref = \'(.*)\';', script.get_text())
-                if mo:
-                    b64 = mo.group(1)
-                    path = base64.b64decode(b64).decode('utf-8')
-                    # Older presentations use flv and the video path does not contain
-                    # the extension. Newer presentations use mp4 and include the extension.
-                    if path.endswith(".mp4"):
-                        return "mp4:%s" % path
-                    elif path.endswith(".flv"):
-                        return "flv:%s" % path[:-4]
-                    else:
-                        raise Exception("Unsupported video type: %s" % path)
+        def get_timecodes(mo):
+            if mo:
+                return [int(tc) for tc in mo.group(1).split(',')]
+
+        def get_slides(mo):
+            if mo:
+                return [slide.replace('\'', '') for slide in  mo.group(1).split(',')]
+
+        def get_video(mo):
+            if mo:
+                b64 = mo.group(1)
+                path = base64.b64decode(b64).decode('utf-8')
+                # Older presentations use flv and the video path does not contain
+                # the extension. Newer presentations use mp4 and include the extension.
+                if path.endswith(".mp4"):
+                    return "mp4:%s" % path
+                elif path.endswith(".flv"):
+                    return "flv:%s" % path[:-4]
+                else:
+                    raise Exception("Unsupported video type: %s" % path)
 
         def get_bio(div):
             return div.find('p', id="biotext").get_text(strip=True)
@@ -137,11 +257,9 @@ class Presentation(object):
         def get_about(div):
             return div.find('p', id="conference").get_text(strip=True)
 
-        def get_demo_timings(pres_div):
-            for script in pres_div.find_all('script'):
-                timings = re.search("demoTimings\s+=\s+'([^']+)", script.get_text())
-                if timings:
-                    return [int(t) for t in timings.group(1).split(',')]
+        def get_demo_timings(mo):
+            if mo:
+                return [int(t) for t in mo.group(1).split(',')]
             return []
 
         def add_pdf_if_exist(metadata, pres_div):
@@ -166,16 +284,17 @@ class Presentation(object):
 
         if not hasattr(self, "_metadata"):
             pres_div = self.soup.find('div', class_='presentation_full')
+            scripts = _search_scripts(self.soup, _TIMECODES_RE, _DEMO_TIMINGS_RE, _SLIDES_RE, _VIDEO_RE)
             metadata = {
                 'url': client.get_url("/presentations/" + self.id),
                 'title': get_title(pres_div),
                 'date' : get_date(pres_div),
                 'auth' : get_author(pres_div),
-                'timecodes': get_timecodes(self.soup),
-                'demo_timings': get_demo_timings(self.soup),
-                'slides': get_slides(self.soup),
+                'timecodes': get_timecodes(scripts[0]),
+                'demo_timings': get_demo_timings(scripts[1]),
+                'slides': get_slides(scripts[2]),
                 'video_url': six.u("rtmpe://video.infoq.com/cfx/st/"),
-                'video_path': get_video(self.soup),
+                'video_path': get_video(scripts[3]),
                 'bio':        get_bio(pres_div),
                 'summary':    get_summary(pres_div),
                 'about':      get_about(pres_div),
@@ -185,29 +304,77 @@ class Presentation(object):
             add_pdf_if_exist(metadata, pres_div)
 
             self._metadata = metadata
+            if self.client.cache:
+                self.client.cache.put_metadata(self.id, self._digest, METADATA_VERSION,
+                                                _encode_metadata(metadata))
 
         return self._metadata
 
 
+def _search_scripts(soup, *patterns):
+    """Search the patterns in the scripts of the soup, walking the scripts once.
+
+    Returns:
+        The list of the first match of each pattern, None if not found
+    """
+    matches = [None] * len(patterns)
+    missing = len(patterns)
+    for script in soup.find_all('script'):
+        # Not get_text(), some tree builders (html5lib) do not report script contents as text
+        text = script.string or ""
+        for i, pattern in enumerate(patterns):
+            if matches[i] is None:
+                matches[i] = pattern.search(text)
+                if matches[i]:
+                    missing -= 1
+        if not missing:
+            break
+    return matches
+
+
+def _encode_metadata(metadata):
+    """Return a copy of the metadata serializable to JSON"""
+    encoded = dict(metadata)
+    encoded['date'] = metadata['date'].strftime(_METADATA_DATE_FORMAT)
+    return encoded
+
+
+def _decode_metadata(encoded):
+    """Reverse _encode_metadata"""
+    metadata = dict(encoded)
+    metadata['date'] = datetime.datetime.strptime(encoded['date'], _METADATA_DATE_FORMAT)
+    return metadata
+
+
 class _RightBarPage(object):
     """A page returned by /rightbar.action
 
     This page lists all available presentations with pagination.
+
+    Only the presentation summaries are parsed into the soup. The html5lib parser does not
+    support partial parsing and builds the whole page.
     """
 
-    def __init__(self, client, index):
+    def __init__(self, client, index, content=None, parser=None):
         self.client = client
         self.index = index
+        self.parser = parser or DEFAULT_PARSER
+        if content is not None:
+            self._soup = self._parse(content)
+
+    def _parse(self, content):
+        parse_only = None if self.parser == "html5lib" else _SUMMARIES_STRAINER
+        return bs4.BeautifulSoup(content, self.parser, parse_only=parse_only)
 
     @property
     def soup(self):
-        """Download the page and create the soup"""
+        """Download the page and create the soup of the summaries"""
         try:
             return self._soup
         except AttributeError:
             url = client.get_url("/presentations/%s" % self.index)
-            content = self.client.fetch_no_cache(url).decode('utf-8')
-            self._soup = bs4.BeautifulSoup(content, "html.parser")
+            content = self.client.fetch(url, max_age=LISTING_MAX_AGE).decode('utf-8')
+            self._soup = self._parse(content)
 
             return self._soup
 
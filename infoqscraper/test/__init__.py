@@ -22,8 +22,18 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import datetime
 from functools import wraps
+import hashlib
+import io
 import os
+import stat
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
 
 from infoqscraper import cache
 from infoqscraper import scrap
@@ -48,6 +58,274 @@ def use_cache(func):
     return _use_cache
 
 
+def read_data(name):
+    """ Return the content of a hand-written sample page from the data directory """
+    with io.open(os.path.join(os.path.dirname(__file__), "data", name), encoding="utf-8") as f:
+        return f.read()
+
+
+# A tool logging its calls and when it starts and ends, failing on demand and writing "output of <first argument>" into its output file,
+# the argument following -o or the last one
+_FAKE_TOOL = """#!%(python)s
+import os, sys, time
+name = os.path.abspath(__file__)
+def log(path, line):
+    with open(os.path.join(os.path.dirname(name), path), "a") as f:
+        f.write(line + "\\n")
+log("calls", os.path.basename(name))
+log("runs", "start " + os.path.basename(name))
+try:
+    time.sleep(%(delay)s)
+    src = sys.argv[1]
+    if os.path.exists(name + ".fail") or os.path.basename(src).startswith("bad"):
+        sys.stderr.write("Cannot process " + src)
+        sys.exit(1)
+    dst = sys.argv[sys.argv.index("-o") + 1] if "-o" in sys.argv else sys.argv[-1]
+    with open(dst, "w") as f:
+        f.write("output of " + src)
+finally:
+    log("runs", "end " + os.path.basename(name))
+"""
+
+
+class FakeTools(object):
+    """ Executable scripts standing for rtmpdump, swfrender and ffmpeg.
+
+    Allow to test conversions without the real tools. A tool fails while failing() is set for it,
+    or when its first argument is a file named bad*.
+
+    Attributes:
+        paths: A dictionary of the tool paths, keyed by tool name. Can be used as Converter keyword arguments.
+    """
+
+    NAMES = ["rtmpdump", "swfrender", "ffmpeg"]
+
+    def __init__(self, dir, delays=None):
+        """
+        Args:
+            dir: The directory where the scripts are created
+            delays: A dictionary of the seconds each tool takes to run, keyed by tool name
+        """
+        self.dir = dir
+        self.paths = {}
+        for name in self.NAMES:
+            self.paths[name] = os.path.join(dir, name)
+            with open(self.paths[name], "w") as f:
+                f.write(_FAKE_TOOL % {"python": sys.executable, "delay": (delays or {}).get(name, 0)})
+            os.chmod(self.paths[name], stat.S_IRWXU)
+
+    def failing(self, name, fail=True):
+        """ Make a tool fail, or succeed again if fail is False """
+        path = self.paths[name] + ".fail"
+        if fail:
+            open(path, "w").close()
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    def calls(self):
+        """ Returns the names of the tools run since the last call, in order """
+        path = os.path.join(self.dir, "calls")
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            calls = f.read().split()
+        os.unlink(path)
+        return calls
+
+    def max_running(self, *names):
+        """ Returns the highest number of the given tools which ran at once.
+
+        The runs are ordered by the start and end events logged by the tools themselves, rather
+        than timed, so that a slow machine does not change the result.
+        """
+        running = 0
+        max_running = 0
+        for event, name in self._runs():
+            if name in names:
+                running += 1 if event == "start" else -1
+                max_running = max(max_running, running)
+        return max_running
+
+    def overlapped(self, name, other):
+        """ Returns whether a run of the tool name overlapped a run of the tool other """
+        running = {name: 0, other: 0}
+        for event, tool in self._runs():
+            if tool in running:
+                running[tool] += 1 if event == "start" else -1
+                if running[name] and running[other]:
+                    return True
+        return False
+
+    def _runs(self):
+        path = os.path.join(self.dir, "runs")
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [line.split() for line in f if line.strip()]
+
+
 def get_latest_presentation(client):
     summary = next(scrap.get_summaries(client))
-    return scrap.Presentation(client, summary['id'])
\ No newline at end of file
+    return scrap.Presentation(client, summary['id'])
+
+
+class ListingClient(object):
+    """ A web client serving generated listing pages rather than fetching them.
+
+    Presentation p<i> is published i days before June 30, 2014 by "Speaker <i % 5>". Presentation
+    new<j>, if any, is published j days after July 1, 2014.
+
+    Attributes:
+        count: Number of presentations published until June 30
+        page_size: Number of presentations per page
+        new: Number of presentations published since July 1
+        fetched: Indexes of the fetched pages, in order
+    """
+
+    cache = None
+
+    def __init__(self, count, page_size=12, new=0):
+        self.count = count
+        self.page_size = page_size
+        self.new = new
+        self.fetched = []
+        self._lock = threading.Lock()
+
+    def fetch(self, url, max_age=None):
+        index = int(url.rsplit('/', 1)[1])
+        with self._lock:
+            self.fetched.append(index)
+        divs = []
+        for k in range(index, min(index + self.page_size, self.new + self.count)):
+            if k < self.new:
+                i = self.new - 1 - k
+                id = "new%d" % i
+                date = datetime.date(2014, 7, 1) + datetime.timedelta(days=i)
+            else:
+                i = k - self.new
+                id = "p%d" % i
+                date = datetime.date(2014, 6, 30) - datetime.timedelta(days=i)
+            divs.append("""
+                <div class="news_type_video">
+                    <h2 class="itemtitle"><a href="/presentations/%s" title="Presentation %d">P</a></h2>
+                    <span class="author">by <a href="/author/a" title="Speaker %d">Speaker</a> on %s %d, %d</span>
+                    <p>Description %d</p>
+                </div>""" % (id, i, i % 5, date.strftime("%b"), date.day, date.year, i))
+        return ("<html><body>%s</body></html>" % "".join(divs)).encode('utf-8')
+
+
+class LocalServer(object):
+    """ A throwaway HTTP server serving in-memory resources on localhost.
+
+    Allow to test the web client without relying on www.infoq.com.
+
+    Attributes:
+        resources: A dictionary of served resources. Keys are paths. Values are bytes.
+        delay: Seconds to wait before answering each request
+        requests: Number of requests received
+        connections: Number of TCP connections accepted
+        max_concurrency: Highest number of requests processed simultaneously
+        not_modified: Number of conditional requests answered by 304 Not Modified
+        redirects: A dictionary of paths redirected by a 302 Found. Values are the target paths.
+        chunked: Send the resources with the chunked transfer encoding rather than a Content-Length
+
+    Resources are served with an ETag, the SHA-1 digest of their content, and a fixed
+    Last-Modified date. Conditional requests are honored.
+    """
+
+    LAST_MODIFIED = "Sat, 01 Jul 2017 00:00:00 GMT"
+    CHUNK_SIZE = 100
+
+    def __init__(self, resources=None, delay=0, redirects=None, chunked=False):
+        self.resources = resources or {}
+        self.delay = delay
+        self.redirects = redirects or {}
+        self.chunked = chunked
+        self.requests = 0
+        self.connections = 0
+        self.max_concurrency = 0
+        self.not_modified = 0
+        self._concurrency = 0
+        self._lock = threading.Lock()
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # Clients closing connections early are expected
+                pass
+
+        self._server = Server(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self._server.server_address[1], path)
+
+    def _handler_class(self):
+        local_server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                with local_server._lock:
+                    local_server.connections += 1
+
+            def do_GET(self):
+                with local_server._lock:
+                    local_server.requests += 1
+                    local_server._concurrency += 1
+                    local_server.max_concurrency = max(local_server.max_concurrency, local_server._concurrency)
+                try:
+                    time.sleep(local_server.delay)
+                    if self.path in local_server.redirects:
+                        self.send_response(302)
+                        self.send_header("Location", local_server.redirects[self.path])
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    content = local_server.resources.get(self.path)
+                    if content is None:
+                        self.send_error(404)
+                        return
+                    etag = '"%s"' % hashlib.sha1(content).hexdigest()
+                    if self.headers.get("If-None-Match") == etag or \
+                            self.headers.get("If-Modified-Since") == local_server.LAST_MODIFIED:
+                        with local_server._lock:
+                            local_server.not_modified += 1
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", local_server.LAST_MODIFIED)
+                    if local_server.chunked:
+                        self.send_header("Transfer-Encoding", "chunked")
+                        self.end_headers()
+                        for i in range(0, len(content), local_server.CHUNK_SIZE):
+                            chunk = content[i:i + local_server.CHUNK_SIZE]
+                            self.wfile.write(("%x\r\n" % len(chunk)).encode("ascii") + chunk + b"\r\n")
+                        self.wfile.write(b"0\r\n\r\n")
+                    else:
+                        self.send_header("Content-Length", str(len(content)))
+                        self.end_headers()
+                        self.wfile.write(content)
+                finally:
+                    with local_server._lock:
+                        local_server._concurrency -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from infoqscraper import cache
+from infoqscraper import client
+from infoqscraper import scrap
+from infoqscraper import test
+from infoqscraper import DownloadError
+
+from infoqscraper.test.compat import unittest
+
+if sys.version_info >= (3, 6):
+    import asyncio
+    from infoqscraper import aio
+
+    class _LocalInfoQ(aio.InfoQ):
+        """ Fetch the InfoQ pages from a LocalServer """
+
+        def __init__(self, server, **kwargs):
+            aio.InfoQ.__init__(self, **kwargs)
+            self.server = server
+
+        def fetch(self, url, max_age=None):
+            return aio.InfoQ.fetch(self, url.replace(client.get_url(""), self.server.url("")), max_age)
+
+        def fetch_no_cache(self, url):
+            return aio.InfoQ.fetch_no_cache(self, url.replace(client.get_url(""), self.server.url("")))
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio API requires Python >= 3.6")
+class TestAsyncClient(unittest.TestCase):
+
+    def setUp(self):
+        self.iq = aio.InfoQ()
+        self.loop = asyncio.new_event_loop()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.resources = dict(("/slide%d.jpg" % i, b"x" * i) for i in range(50))
+
+    def tearDown(self):
+        self.iq.close()
+        self.loop.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_until_complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_fetch(self):
+        with test.LocalServer(self.resources) as server:
+            content = self.run_until_complete(self.iq.fetch(server.url("/slide42.jpg")))
+        self.assertEqual(content, b"x" * 42)
+
+    def test_fetch_revalidation(self):
+        self.iq.cache = cache.XDGCache()
+        self.iq.cache.dir = self.tmp_dir
+        with test.LocalServer(self.resources) as server:
+            url = server.url("/slide42.jpg")
+            self.run_until_complete(self.iq.fetch(url))
+            with self.iq.cache._index(write=True) as index:
+                index.execute("UPDATE entries SET mtime = mtime - 120")
+            content = self.run_until_complete(self.iq.fetch(url, max_age=60))
+            self.assertEqual(server.not_modified, 1)
+        self.assertEqual(content, b"x" * 42)
+
+    def test_fetch_error(self):
+        with test.LocalServer(self.resources) as server:
+            with self.assertRaises(DownloadError):
+                self.run_until_complete(self.iq.fetch(server.url("/IDONOTEXIST")))
+
+    def test_download_all(self):
+        self.iq.max_connections_per_host = 4
+        with test.LocalServer(self.resources, delay=0.01) as server:
+            urls = [server.url("/slide%d.jpg" % i) for i in range(50)]
+            paths = self.run_until_complete(self.iq.download_all(urls, self.tmp_dir))
+            self.assertLessEqual(server.max_concurrency, 4)
+            self.assertLessEqual(server.connections, 4)
+
+        self.assertEqual([os.path.basename(p) for p in paths], ["slide%d.jpg" % i for i in range(50)])
+        for i, path in enumerate(paths):
+            self.assertEqual(os.path.getsize(path), i)
+
+    def test_download_all_error_cleanup(self):
+        with test.LocalServer(self.resources) as server:
+            urls = [server.url("/slide%d.jpg" % i) for i in range(50)]
+            urls.insert(25, server.url("/IDONOTEXIST"))
+            with self.assertRaises(DownloadError):
+                self.run_until_complete(self.iq.download_all(urls, self.tmp_dir))
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_download_streamed(self):
+        self.iq.chunk_size = 7
+        self.resources["/video.mp4"] = os.urandom(1000)
+        with test.LocalServer(self.resources) as server:
+            path = self.run_until_complete(self.iq.download(server.url("/video.mp4"), self.tmp_dir))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.resources["/video.mp4"])
+
+    def test_download_chunked(self):
+        self.iq.chunk_size = 7
+        self.resources["/video.mp4"] = os.urandom(1000)
+        with test.LocalServer(self.resources, chunked=True) as server:
+            path = self.run_until_complete(self.iq.download(server.url("/video.mp4"), self.tmp_dir))
+            content = self.run_until_complete(self.iq.fetch(server.url("/video.mp4")))
+            # The connection is still usable once the last chunk is read
+            self.assertEqual(server.connections, 1)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.resources["/video.mp4"])
+        self.assertEqual(content, self.resources["/video.mp4"])
+
+    def test_redirect(self):
+        redirects = {"/old": "/slide42.jpg", "/gone": "/IDONOTEXIST"}
+        with test.LocalServer(self.resources, redirects=redirects) as server:
+            content = self.run_until_complete(self.iq.fetch(server.url("/old")))
+            with self.assertRaises(DownloadError):
+                self.run_until_complete(self.iq.fetch(server.url("/gone")))
+        self.assertEqual(content, b"x" * 42)
+
+    def test_cache_options(self):
+        iq = aio.InfoQ(cache_enabled=True, cache_max_size=1000, cache_compression="zlib")
+        self.assertEqual(iq.cache.max_size, 1000)
+        self.assertEqual(iq.cache.compression, "zlib")
+
+    def test_cache_off_event_loop(self):
+        self.iq.cache = cache.XDGCache()
+        self.iq.cache.dir = self.tmp_dir
+        threads = set()
+        get_content = self.iq.cache.get_content
+
+        def recording_get_content(*args):
+            threads.add(threading.current_thread())
+            return get_content(*args)
+        self.iq.cache.get_content = recording_get_content
+
+        with test.LocalServer(self.resources) as server:
+            self.run_until_complete(self.iq.fetch(server.url("/slide42.jpg")))
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio API requires Python >= 3.6")
+class TestAsyncScraping(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.resources = {
+            "/presentations/0": test.read_data("presentations.html").encode("utf-8"),
+            "/presentations/12": test.read_data("presentations.html").encode("utf-8"),
+            "/presentations/24": b"<html><body></body></html>",
+            "/presentations/fixture": test.read_data("presentation.html").encode("utf-8"),
+        }
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_until_complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def collect(self, summaries):
+        """ Returns the items of an asynchronous generator """
+        items = []
+        while True:
+            try:
+                items.append(self.run_until_complete(summaries.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def test_get_summaries(self):
+        with test.LocalServer(self.resources) as server:
+            iq = _LocalInfoQ(server)
+            summaries = self.collect(aio.get_summaries(iq))
+            iq.close()
+
+        reference = scrap._RightBarPage(client.InfoQ(), 0, content=test.read_data("presentations.html")).summaries()
+        self.assertEqual(summaries, reference * 2)
+
+    def test_get_summaries_filter(self):
+        with test.LocalServer(self.resources) as server:
+            iq = _LocalInfoQ(server)
+            summaries = self.collect(aio.get_summaries(iq, filter=scrap.MaxPagesFilter(1)))
+            iq.close()
+        self.assertEqual(len(summaries), 12)
+
+    def test_get_presentation(self):
+        with test.LocalServer(self.resources) as server:
+            iq = _LocalInfoQ(server)
+            iq.cache = cache.XDGCache()
+            iq.cache.dir = self.tmp_dir
+            presentation = self.run_until_complete(aio.get_presentation(iq, "fixture"))
+            iq.close()
+
+        reference = scrap.Presentation(client.InfoQ(), "fixture", content=test.read_data("presentation.html"))
+        self.assertEqual(presentation.metadata, reference.metadata)
+        # The metadata were extracted and cached while getting the presentation
+        self.assertIsNotNone(iq.cache.get_metadata("fixture", presentation._digest, scrap.METADATA_VERSION))
+
+    def test_get_presentation_after_login(self):
+        with test.LocalServer(self.resources) as server:
+            iq = _LocalInfoQ(server)
+            iq.cache = cache.XDGCache()
+            iq.cache.dir = self.tmp_dir
+            self.run_until_complete(aio.get_presentation(iq, "fixture"))
+
+            # The page of an authenticated client is fetched again, not read from the cache
+            iq.authenticated = True
+            self.resources["/presentations/fixture"] = self.resources["/presentations/fixture"].replace(
+                b"Jun 12, 2014", b"Jul 14, 2014")
+            presentation = self.run_until_complete(aio.get_presentation(iq, "fixture"))
+            iq.close()
+        self.assertEqual(presentation.metadata['date'], datetime.datetime(2014, 7, 14))
@@ -22,11 +22,15 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
+import multiprocessing
 import os
 import shutil
+import sqlite3
 import tempfile
 
 from infoqscraper import cache
+from infoqscraper import client
 
 from infoqscraper.test.compat import unittest
 
@@ -93,6 +97,61 @@ class TestCache(unittest.TestCase):
         self.cache.put_content(url, content)
         self.assertEqual(self.cache.get_content(url), content)
 
+    def test_max_age(self):
+        url = "http://example.com/foo"
+        self.cache.put_content(url, b"content")
+        self.assertEqual(self.cache.get_content(url, max_age=60), b"content")
+
+        with self.cache._index(write=True) as index:
+            index.execute("UPDATE entries SET mtime = mtime - 120")
+        self.assertIsNone(self.cache.get_content(url, max_age=60))
+        self.assertEqual(self.cache.get_content(url), b"content")
+
+        # Putting the resource again makes it fresh
+        self.cache.put_content(url, b"content")
+        self.assertEqual(self.cache.get_content(url, max_age=60), b"content")
+
+    def test_validators(self):
+        url = "http://example.com/foo"
+        self.assertEqual(self.cache.get_validators(url), (None, None))
+        self.cache.put_content(url, b"V1", etag='"v1"', last_modified="Sat, 01 Jul 2017 00:00:00 GMT")
+        self.assertEqual(self.cache.get_validators(url), ('"v1"', "Sat, 01 Jul 2017 00:00:00 GMT"))
+
+        with self.cache._index(write=True) as index:
+            index.execute("UPDATE entries SET mtime = mtime - 120")
+        self.assertEqual(self.cache.get_validators(url), ('"v1"', "Sat, 01 Jul 2017 00:00:00 GMT"))
+        self.assertEqual(self.cache.refresh(url), b"V1")
+        self.assertEqual(self.cache.get_content(url, max_age=60), b"V1")
+
+        self.cache.put_content(url, b"V2")
+        self.assertEqual(self.cache.get_validators(url), (None, None))
+
+    def test_schema_upgrade(self):
+        conn = sqlite3.connect(os.path.join(self.cache.dir, "index.sqlite"), isolation_level=None)
+        self.cache._create_schema(conn)
+        conn.execute("PRAGMA user_version = 1")
+        conn.close()
+
+        self.cache.put_content("http://example.com/foo", b"content")
+        self.assertEqual(self.cache.get_content("http://example.com/foo", max_age=60), b"content")
+
+    def test_metadata(self):
+        self.cache.put_metadata("foo", "digest", 1, {"title": "Foo"})
+        self.assertEqual(self.cache.get_metadata("foo", "digest", 1), {"title": "Foo"})
+        self.assertIsNone(self.cache.get_metadata("foo", "other", 1))
+        self.assertIsNone(self.cache.get_metadata("foo", "digest", 2))
+
+    def test_metadata_schema_upgrade(self):
+        conn = sqlite3.connect(os.path.join(self.cache.dir, "index.sqlite"), isolation_level=None)
+        self.cache._create_schema(conn)
+        conn.execute("CREATE TABLE metadata (id TEXT PRIMARY KEY, digest TEXT NOT NULL, data TEXT NOT NULL)")
+        conn.execute("INSERT INTO metadata (id, digest, data) VALUES ('foo', 'digest', '{}')")
+        conn.execute("PRAGMA user_version = 4")
+        conn.close()
+
+        # Metadata extracted by an unknown version are not trusted
+        self.assertIsNone(self.cache.get_metadata("foo", "digest", 1))
+
     def test_size(self):
         url = "http://example.com/foo"
         content = b"x" * 1026
@@ -100,4 +159,281 @@ class TestCache(unittest.TestCase):
         size = self.cache.size
         self.assertEqual(size, 1026)
 
+    def test_size_accounting(self):
+        self.assertEqual(self.cache.size, 0)
+        self.cache.put_content("http://example.com/foo", b"x" * 1000)
+        self.cache.put_content("http://example.com/foo", b"x" * 1000)
+        self.cache.put_content("http://example.com/bar", b"y" * 500)
+        self.assertEqual(self.cache.size, 1500)
+        self.cache.put_content("http://example.com/bar", b"y" * 200)
+        self.assertEqual(self.cache.size, 1200)
+        self.assertEqual(self.cache.verify_size(), 1200)
+
+    def test_verify_size(self):
+        self.cache.put_content("http://example.com/foo", b"x" * 1000)
+        os.unlink(self.cache.get_path("http://example.com/foo"))
+        self.assertEqual(self.cache.size, 1000)
+        self.assertEqual(self.cache.verify_size(), 0)
+        self.assertEqual(self.cache.size, 0)
+        self.assertIsNone(self.cache.get_path("http://example.com/foo"))
+        self.cache.put_content("http://example.com/foo", b"x" * 1000)
+        self.assertEqual(self.cache.size, 1000)
+
+    def test_verify_size_deletes_unindexed_objects(self):
+        self.cache.put_content("http://example.com/foo", b"x" * 1000)
+        # Left by a process killed before indexing it
+        orphan = self.cache._object_path(hashlib.sha1(b"y" * 500).hexdigest())
+        os.makedirs(os.path.dirname(orphan))
+        with open(orphan, "wb") as f:
+            f.write(b"y" * 500)
+
+        self.assertEqual(self.cache.verify_size(), 1000)
+        self.assertEqual(self.cache.size, 1000)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.cache.get_content("http://example.com/foo"), b"x" * 1000)
+        # Eviction can reach the limit again
+        self.assertEqual(self.cache.prune(0), 1000)
+        self.assertEqual(self.cache.verify_size(), 0)
+
+    def test_deduplication(self):
+        content = b"x" * 1026
+        self.cache.put_content("http://example.com/foo", content)
+        self.cache.put_content("http://example.com/bar", content)
+        tmp = tempfile.mktemp()
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        self.cache.put_path("http://example.com/baz", tmp)
+        os.unlink(tmp)
+
+        self.assertEqual(self.cache.get_content("http://example.com/baz"), content)
+        self.assertEqual(self.cache.get_path("http://example.com/foo"), self.cache.get_path("http://example.com/bar"))
+        self.assertEqual(self.cache.size, 1026)
+
+    def test_update_deletes_unreferenced_content(self):
+        self.cache.put_content("http://example.com/foo", b"V1")
+        self.cache.put_content("http://example.com/bar", b"V1")
+        v1_path = self.cache.get_path("http://example.com/foo")
+
+        self.cache.put_content("http://example.com/foo", b"V2")
+        self.assertTrue(os.path.exists(v1_path))
+        self.cache.put_content("http://example.com/bar", b"V2")
+        self.assertFalse(os.path.exists(v1_path))
+        self.assertEqual(self.cache.size, 2)
+
+
+class TestCompression(unittest.TestCase):
+
+    html = b"<html><body>" + b"<div class='news_type_video'>Presentation</div>" * 100 + b"</body></html>"
+
+    def setUp(self):
+        self.cache = cache.XDGCache()
+        self.cache.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.dir)
+
+    def assert_compressed(self, compression):
+        self.cache.compression = compression
+        url = "http://www.infoq.com/presentations/0"
+        self.cache.put_content(url, self.html)
+        self.assertEqual(self.cache.get_content(url), self.html)
+        self.assertLess(self.cache.size, len(self.html) / 5)
+        # Not usable as is
+        self.assertIsNone(self.cache.get_path(url))
+
+    def test_zlib(self):
+        self.assert_compressed("zlib")
+
+    @unittest.skipIf(cache.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        self.assert_compressed("zstd")
+
+    def test_unavailable_codec(self):
+        zstandard = cache.zstandard
+        cache.zstandard = None
+        try:
+            with self.assertRaises(ValueError):
+                cache.XDGCache(compression="zstd")
+            # Checked before the cache is enabled
+            with self.assertRaises(ValueError):
+                client.InfoQ(cache_compression="zstd")
+        finally:
+            cache.zstandard = zstandard
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            cache.XDGCache(compression="lz4")
+
+    def test_media_are_not_compressed(self):
+        self.cache.compression = "zlib"
+        url = "http://www.infoq.com/resource/presentations/foo/en/slides/sl1.jpg"
+        self.cache.put_content(url, self.html)
+        self.assertEqual(self.cache.size, len(self.html))
+        self.assertIsNotNone(self.cache.get_path(url))
+
+    def test_incompressible_content(self):
+        self.cache.compression = "zlib"
+        url = "http://www.infoq.com/presentations/0"
+        content = os.urandom(4096)
+        self.cache.put_content(url, content)
+        self.assertEqual(self.cache.get_content(url), content)
+        self.assertEqual(self.cache.size, len(content))
+
+    def test_disabled(self):
+        self.cache.compression = None
+        url = "http://www.infoq.com/presentations/0"
+        self.cache.put_content(url, self.html)
+        self.assertEqual(self.cache.size, len(self.html))
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.XDGCache()
+        self.cache.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.dir)
+
+    def test_objects_are_sharded(self):
+        self.cache.put_content("http://example.com/foo", b"content")
+        path = os.path.relpath(self.cache.get_path("http://example.com/foo"), self.cache.dir)
+        self.assertEqual(path.split(os.sep)[:3], ["objects", "04", "0f"])
+
+    def test_migrate_url_files(self):
+        # Layout of infoqscraper <= 0.1.5
+        legacy = {
+            "http://www.infoq.com/resource/presentations/foo/en/slides/sl1.jpg": b"slide",
+            "http://www.infoq.com/resource/presentations/foo/en/slides/sl2.jpg": b"slide",
+            "mp4:presentations/foo.mp4": b"video",
+        }
+        for url, content in legacy.items():
+            path = os.path.join(self.cache.dir, url)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(content)
+
+        self.assertEqual(self.cache.migrate(), 3)
+        for url, content in legacy.items():
+            self.assertEqual(self.cache.get_content(url), content)
+        self.assertEqual(sorted(os.listdir(self.cache.dir)), ["index.sqlite", "objects", "tmp"])
+        self.assertEqual(self.cache.size, 10)
+        self.assertEqual(self.cache.migrate(), 0)
+
+    def test_migrate_objects(self):
+        self.cache.put_content("http://example.com/foo", b"content")
+        digest = "040f06fd774092478d450774f5ba30c5da78acc8"
+        # Single level sharding
+        old_path = os.path.join(self.cache.dir, "objects", digest[:2], digest[2:])
+        os.rename(self.cache.get_path("http://example.com/foo"), old_path)
+        self.assertIsNone(self.cache.get_path("http://example.com/foo"))
+
+        self.assertEqual(self.cache.migrate(), 1)
+        self.assertEqual(self.cache.get_content("http://example.com/foo"), b"content")
+        self.assertFalse(os.path.exists(old_path))
+
+
+def _concurrent_puts(args):
+    cache_dir, worker = args
+    c = cache.XDGCache(max_size=10 * 1000)
+    c.dir = cache_dir
+    for i in range(100):
+        # Urls and contents are shared by the workers
+        url = "http://example.com/%d" % (i % 20)
+        c.put_content(url, str(i % 20).encode('ascii') * 1000)
+        content = c.get_content("http://example.com/%d" % ((i + worker) % 20))
+        if content is not None and content != str((i + worker) % 20).encode('ascii') * 1000:
+            return False
+    return True
+
+
+class TestConcurrentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.XDGCache()
+        self.cache.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.dir)
+
+    def test_concurrent_processes(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            results = pool.map(_concurrent_puts, [(self.cache.dir, worker) for worker in range(8)])
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertTrue(all(results))
+        self.assertEqual(self.cache.size, self.cache.verify_size())
+        self.assertEqual(os.listdir(os.path.join(self.cache.dir, "tmp")), [])
+
+    def test_unreadable_file(self):
+        url = "http://example.com/foo"
+        with self.assertRaises(cache.Error):
+            self.cache.put_path(url, os.path.join(self.cache.dir, "IDONOTEXIST"))
+        self.assertIsNone(self.cache.get_path(url))
+        self.assertEqual(self.cache.verify_size(), 0)
+
+
+class TestBoundedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.XDGCache(max_size=3000)
+        self.cache.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.dir)
+
+    def test_lru_eviction(self):
+        self.cache.put_content("http://example.com/1", b"1" * 1000)
+        self.cache.put_content("http://example.com/2", b"2" * 1000)
+        self.cache.put_content("http://example.com/3", b"3" * 1000)
+        with self.cache._index(write=True) as index:
+            index.execute("UPDATE objects SET atime = atime - 120")
+        # 1 becomes the most recently used
+        self.assertIsNotNone(self.cache.get_content("http://example.com/1"))
+
+        self.cache.put_content("http://example.com/4", b"4" * 1000)
+        self.assertIsNone(self.cache.get_content("http://example.com/2"))
+        for i in (1, 3, 4):
+            self.assertIsNotNone(self.cache.get_content("http://example.com/%d" % i))
+        self.assertEqual(self.cache.size, 3000)
+
+    def test_recent_access_time_is_kept(self):
+        self.cache.put_content("http://example.com/1", b"1" * 1000)
+        with self.cache._index() as index:
+            atime = index.execute("SELECT atime FROM objects").fetchone()[0]
+        # Reading a recently used resource does not wait for another writer
+        conn = sqlite3.connect(self.cache._index_path, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self.assertIsNotNone(self.cache.get_content("http://example.com/1"))
+            conn.execute("ROLLBACK")
+        finally:
+            conn.close()
+        with self.cache._index() as index:
+            self.assertEqual(index.execute("SELECT atime FROM objects").fetchone()[0], atime)
+
+    def test_eviction_of_shared_content(self):
+        self.cache.put_content("http://example.com/1", b"1" * 1000)
+        self.cache.put_content("http://example.com/1bis", b"1" * 1000)
+        self.cache.put_content("http://example.com/2", b"2" * 2500)
+        self.assertIsNone(self.cache.get_path("http://example.com/1"))
+        self.assertIsNone(self.cache.get_path("http://example.com/1bis"))
+        self.assertIsNotNone(self.cache.get_path("http://example.com/2"))
+
+    def test_newest_content_is_kept(self):
+        self.cache.put_content("http://example.com/big", b"x" * 5000)
+        self.assertIsNotNone(self.cache.get_path("http://example.com/big"))
 
+    def test_prune(self):
+        self.cache.max_size = None
+        for i in range(5):
+            self.cache.put_content("http://example.com/%d" % i, str(i).encode('ascii') * 1000)
+        self.assertEqual(self.cache.prune(2000), 3000)
+        self.assertEqual(self.cache.size, 2000)
+        self.assertIsNotNone(self.cache.get_path("http://example.com/4"))
+        with self.assertRaises(ValueError):
+            self.cache.prune()
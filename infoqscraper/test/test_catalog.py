@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from infoqscraper import catalog
+from infoqscraper import test
+
+from infoqscraper.test.compat import unittest
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.catalog = catalog.Catalog(os.path.join(self.dir, "catalog.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def summary(self, id, title="Title", desc="Description", auth="Author", date=datetime.datetime(2014, 6, 12)):
+        return {
+            'id': id,
+            'url': "http://www.infoq.com/presentations/" + id,
+            'title': title,
+            'desc': desc,
+            'auth': auth,
+            'date': date,
+        }
+
+    def ids(self, summaries):
+        return [s['id'] for s in summaries]
+
+    def test_empty(self):
+        self.assertEqual(len(self.catalog), 0)
+        self.assertEqual(self.catalog.search("java"), [])
+
+    def test_add(self):
+        summary = self.summary("foo", title="Java Garbage Collection")
+        self.assertEqual(self.catalog.add([summary]), 1)
+        self.assertEqual(self.catalog.search("garbage"), [summary])
+
+        # Known presentations are updated, not added twice
+        summary = self.summary("foo", title="Python Garbage Collection")
+        self.assertEqual(self.catalog.add([summary]), 0)
+        self.assertEqual(len(self.catalog), 1)
+        self.assertEqual(self.catalog.search("java"), [])
+        self.assertEqual(self.catalog.search("python"), [summary])
+
+    def test_search(self):
+        self.catalog.add([
+            self.summary("gc", title="Java GC", desc="Garbage collection in the JVM", auth="Gil Tene"),
+            self.summary("clojure", title="Clojure", desc="The expression problem", auth="Chris Houser"),
+            self.summary("jit", title="JIT", desc="How the JVM compiles Java", auth="Cliff Click"),
+        ])
+        self.assertEqual(sorted(self.ids(self.catalog.search("java"))), ["gc", "jit"])
+        self.assertEqual(self.ids(self.catalog.search("jvm garbage")), ["gc"])
+        self.assertEqual(self.ids(self.catalog.search("houser")), ["clojure"])
+        self.assertEqual(self.catalog.search("scala"), [])
+        # The full-text query syntax is not exposed
+        self.assertEqual(self.ids(self.catalog.search('"java" OR (')), [])
+        self.assertEqual(len(self.catalog.search()), 3)
+
+    def test_filters(self):
+        self.catalog.add([
+            self.summary("a", auth="Gil Tene", date=datetime.datetime(2012, 1, 1)),
+            self.summary("b", auth="Cliff Click", date=datetime.datetime(2013, 1, 1)),
+            self.summary("c", auth="Gil Tene", date=datetime.datetime(2014, 1, 1)),
+        ])
+        self.assertEqual(self.ids(self.catalog.search()), ["c", "b", "a"])
+        self.assertEqual(self.ids(self.catalog.search(author="tene")), ["c", "a"])
+        self.assertEqual(self.ids(self.catalog.search(since=datetime.date(2013, 1, 1))), ["c", "b"])
+        self.assertEqual(self.ids(self.catalog.search(until=datetime.date(2013, 1, 1))), ["b", "a"])
+        self.assertEqual(self.ids(self.catalog.search(author="tene", since=datetime.date(2013, 1, 1))), ["c"])
+        self.assertEqual(self.ids(self.catalog.search(limit=1)), ["c"])
+
+    def test_update(self):
+        iq = test.ListingClient(30)
+        self.assertEqual(self.catalog.update(iq), 30)
+        self.assertEqual(len(self.catalog), 30)
+        self.assertEqual(self.ids(self.catalog.search("description 7")), ["p7"])
+        self.assertEqual(self.catalog.search(limit=1)[0]['date'], datetime.datetime(2014, 6, 30))
+
+        self.assertEqual(self.catalog.update(test.ListingClient(40)), 10)
+        self.assertEqual(len(self.catalog), 40)
+
+    def test_update_max_pages(self):
+        iq = test.ListingClient(100)
+        self.assertEqual(self.catalog.update(iq, max_pages=2), 24)
+        self.assertEqual(sorted(iq.fetched), [0, 12])
+
+
+class TestCatalogSync(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.catalog = catalog.Catalog(os.path.join(self.dir, "catalog.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_first_sync_walks_everything(self):
+        self.assertIsNone(self.catalog.high_water_mark())
+        self.assertEqual(self.catalog.sync(test.ListingClient(30)), 30)
+        self.assertEqual(self.catalog.high_water_mark(), ("p0", datetime.datetime(2014, 6, 30)))
+
+    def test_sync_stops_at_mark(self):
+        self.catalog.update(test.ListingClient(100))
+
+        iq = test.ListingClient(100, new=3)
+        self.assertEqual(self.catalog.sync(iq), 3)
+        self.assertEqual(iq.fetched, [0])
+        self.assertEqual(self.catalog.high_water_mark(), ("new2", datetime.datetime(2014, 7, 3)))
+        self.assertEqual(len(self.catalog), 103)
+
+        iq = test.ListingClient(100, new=20)
+        self.assertEqual(self.catalog.sync(iq), 17)
+        self.assertEqual(iq.fetched, [0, 12])
+
+        iq = test.ListingClient(100, new=20)
+        self.assertEqual(self.catalog.sync(iq), 0)
+        self.assertEqual(iq.fetched, [0])
+
+    def test_mark_removed(self):
+        self.catalog.sync(test.ListingClient(50))
+        with self.catalog._connect(write=True) as conn:
+            conn.execute("UPDATE state SET value = 'removed' WHERE name = 'newest_id'")
+        # The mark cannot be reached, paging stops at the first older presentation
+        iq = test.ListingClient(50, new=2)
+        self.assertEqual(self.catalog.sync(iq), 2)
+        self.assertEqual(iq.fetched, [0])
+        self.assertEqual(self.catalog.high_water_mark()[0], "new1")
+
+    def test_partial_update_keeps_mark(self):
+        self.catalog.update(test.ListingClient(50))
+        # The first pages do not reach the previous mark, it must not move
+        self.catalog.update(test.ListingClient(50, new=30), max_pages=1)
+        self.assertEqual(self.catalog.high_water_mark()[0], "p0")
+        self.assertEqual(self.catalog.sync(test.ListingClient(50, new=30)), 18)
+        self.assertEqual(self.catalog.high_water_mark()[0], "new29")
+
+    def test_bounded_update_sets_no_mark(self):
+        self.catalog.update(test.ListingClient(100), max_pages=2)
+        self.assertEqual(len(self.catalog), 24)
+        self.assertIsNone(self.catalog.high_water_mark())
+        # The first sync still walks the whole listing
+        self.assertEqual(self.catalog.sync(test.ListingClient(100)), 76)
+        self.assertEqual(len(self.catalog), 100)
+        self.assertEqual(self.catalog.high_water_mark()[0], "p0")
@@ -22,10 +22,16 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import errno
+import hashlib
 import os
 import shutil
+import socket
 import tempfile
 
+from six.moves import urllib
+
+from infoqscraper import cache
 from infoqscraper import client
 from infoqscraper import test
 
@@ -147,3 +153,185 @@ class TestDownload(unittest.TestCase):
         self.assert_tmp_dir_nb_files(n)
 
 
+class TestParallelDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.iq = client.InfoQ()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.resources = dict(("/slide%d.jpg" % i, b"x" * i) for i in range(20))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_download_all_keeps_order(self):
+        with test.LocalServer(self.resources) as server:
+            urls = [server.url("/slide%d.jpg" % i) for i in range(20)]
+            paths = self.iq.download_all(urls, self.tmp_dir, jobs=4)
+
+        self.assertEqual([os.path.basename(p) for p in paths], ["slide%d.jpg" % i for i in range(20)])
+        for i, path in enumerate(paths):
+            self.assertEqual(os.path.getsize(path), i)
+
+    def test_download_all_per_host_limit(self):
+        self.iq.max_connections_per_host = 2
+        with test.LocalServer(self.resources, delay=0.05) as server:
+            urls = [server.url("/slide%d.jpg" % i) for i in range(20)]
+            self.iq.download_all(urls, self.tmp_dir, jobs=8)
+            self.assertLessEqual(server.max_concurrency, 2)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 20)
+
+    def test_download_all_error_cleanup(self):
+        with test.LocalServer(self.resources) as server:
+            urls = [server.url("/slide%d.jpg" % i) for i in range(20)]
+            urls.insert(10, server.url("/IDONOTEXIST"))
+            with self.assertRaises(client.DownloadError):
+                self.iq.download_all(urls, self.tmp_dir, jobs=4)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.iq = client.InfoQ()
+        self.resources = dict(("/slide%d.jpg" % i, b"x" * 1000) for i in range(10))
+
+    def test_connection_reused(self):
+        with test.LocalServer(self.resources) as server:
+            for i in range(10):
+                self.assertEqual(self.iq.fetch(server.url("/slide%d.jpg" % i)), b"x" * 1000)
+            self.assertEqual(server.connections, 1)
+
+        self.assertEqual(self.iq.pool.misses, 1)
+        self.assertEqual(self.iq.pool.hits, 9)
+        self.assertEqual(self.iq.pool.size, 1)
+
+    def test_connection_reused_after_error(self):
+        with test.LocalServer(self.resources) as server:
+            with self.assertRaises(client.DownloadError):
+                self.iq.fetch(server.url("/IDONOTEXIST"))
+            self.assertEqual(self.iq.fetch(server.url("/slide0.jpg")), b"x" * 1000)
+            self.assertEqual(self.iq.fetch(server.url("/slide1.jpg")), b"x" * 1000)
+
+        self.assertEqual(self.iq.pool.size, 1)
+
+    def test_retry_on_a_new_connection(self):
+        stale = _StaleConnections()
+        with test.LocalServer(self.resources) as server:
+            host = server.url("").split("//")[1]
+            for i in range(3):
+                self.iq.pool.release("http", host, stale.connection())
+            self.assertEqual(self.iq.fetch(server.url("/slide0.jpg")), b"x" * 1000)
+            self.assertEqual(server.connections, 1)
+
+        # A single idle connection was tried before the new one
+        self.assertEqual(stale.requests, 1)
+        self.assertEqual(self.iq.pool.size, 3)
+
+    def test_post_on_a_new_connection(self):
+        stale = _StaleConnections()
+        with test.LocalServer(self.resources) as server:
+            host = server.url("").split("//")[1]
+            self.iq.pool.release("http", host, stale.connection())
+            # The server does not support POST, but got the request
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.iq.opener.open(server.url("/slide0.jpg"), b"data")
+            cm.exception.close()
+            self.assertEqual(server.connections, 1)
+
+        self.assertEqual(stale.requests, 0)
+
+
+class _StaleConnections(object):
+    """ Idle connections closed by the server in the meantime
+
+    Attributes:
+        requests: Number of requests sent over the connections
+    """
+
+    def __init__(self):
+        self.requests = 0
+
+    def connection(self):
+        stale = self
+
+        class Connection(object):
+            def request(self, *args):
+                stale.requests += 1
+                raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+
+            def close(self):
+                pass
+
+        return Connection()
+
+
+class TestStreamedDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.iq = client.InfoQ(chunk_size=7)
+        self.iq.cache = cache.XDGCache()
+        self.iq.cache.dir = tempfile.mkdtemp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.content = os.urandom(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        shutil.rmtree(self.iq.cache.dir)
+
+    def test_download_is_cached(self):
+        with test.LocalServer({"/video.mp4": self.content}) as server:
+            url = server.url("/video.mp4")
+            path = self.iq.download(url, self.tmp_dir)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(self.iq.cache.get_content(url), self.content)
+
+        # The server is gone, the resource must come from the cache
+        os.unlink(path)
+        path = self.iq.download(url, self.tmp_dir, filename="copy.mp4")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_fetch_max_age(self):
+        with test.LocalServer({"/page": b"page"}) as server:
+            url = server.url("/page")
+            self.assertEqual(self.iq.fetch(url, max_age=60), b"page")
+            self.assertEqual(self.iq.fetch(url, max_age=60), b"page")
+            self.assertEqual(server.requests, 1)
+
+            with self.iq.cache._index(write=True) as index:
+                index.execute("UPDATE entries SET mtime = mtime - 120")
+            self.assertEqual(self.iq.fetch(url), b"page")
+            self.assertEqual(server.requests, 1)
+            self.assertEqual(self.iq.fetch(url, max_age=60), b"page")
+            self.assertEqual(server.requests, 2)
+
+    def test_fetch_revalidation(self):
+        resources = {"/page": b"page"}
+        with test.LocalServer(resources) as server:
+            url = server.url("/page")
+            self.assertEqual(self.iq.fetch(url), b"page")
+            self.assertEqual(self.iq.cache.get_validators(url), ('"%s"' % hashlib.sha1(b"page").hexdigest(),
+                                                                 server.LAST_MODIFIED))
+
+            with self.iq.cache._index(write=True) as index:
+                index.execute("UPDATE entries SET mtime = mtime - 120")
+            self.assertEqual(self.iq.fetch(url, max_age=60), b"page")
+            self.assertEqual(server.not_modified, 1)
+            # Revalidated, the cached page is fresh again
+            self.assertEqual(self.iq.fetch(url, max_age=60), b"page")
+            self.assertEqual(server.requests, 2)
+
+            resources["/page"] = b"new page"
+            server.LAST_MODIFIED = "Sun, 02 Jul 2017 00:00:00 GMT"
+            with self.iq.cache._index(write=True) as index:
+                index.execute("UPDATE entries SET mtime = mtime - 120")
+            self.assertEqual(self.iq.fetch(url, max_age=60), b"new page")
+            self.assertEqual(server.not_modified, 1)
+            self.assertEqual(self.iq.cache.get_content(url), b"new page")
+
+    def test_download_error_leaves_no_file(self):
+        with test.LocalServer({}) as server:
+            with self.assertRaises(client.DownloadError):
+                self.iq.download(server.url("/video.mp4"), self.tmp_dir)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
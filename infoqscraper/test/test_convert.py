@@ -22,14 +22,20 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import json
 import os
+import re
 import shutil
+import subprocess
+import sys
 import tempfile
 
+from infoqscraper import cache
 from infoqscraper import client
 from infoqscraper import convert
 from infoqscraper import scrap
 from infoqscraper import test
+from infoqscraper import ConversionError
 
 from infoqscraper.test.compat import unittest
 
@@ -54,3 +60,384 @@ class TestSwfConverter(unittest.TestCase):
         convert.swf2png(swf_path, png_path)
         stat_info = os.stat(png_path)
         self.assertGreater(stat_info.st_size, 1000)
+
+
+@unittest.skipIf(sys.platform.startswith("win32"), "requires an executable script")
+class TestSlideRendering(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tools = test.FakeTools(self.tmp_dir, delays={"swfrender": 0.3})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def converter(self, render_jobs):
+        return convert.Converter(None, os.path.join(self.tmp_dir, "output.avi"), ffmpeg="ffmpeg", rtmpdump="rtmpdump",
+                                 swfrender=self.tools.paths["swfrender"], overwrite=False, type="h264",
+                                 render_jobs=render_jobs)
+
+    def slides(self, names):
+        return [os.path.join(self.tmp_dir, name) for name in names]
+
+    def test_parallel_rendering(self):
+        slides = self.slides(["slide%d.swf" % i for i in range(8)] + ["slide8.jpg"])
+        with self.converter(render_jobs=4) as converter:
+            pngs = converter._convert_slides(slides)
+
+        # Order is kept
+        self.assertEqual(pngs, self.slides(["slide%d.png" % i for i in range(8)] + ["slide8.jpg"]))
+        for i in range(8):
+            with open(pngs[i]) as f:
+                self.assertEqual(f.read(), "output of " + slides[i])
+        # Slides are rendered concurrently, at most render_jobs at once
+        self.assertGreater(self.tools.max_running("swfrender"), 1)
+        self.assertLessEqual(self.tools.max_running("swfrender"), 4)
+
+    def test_render_jobs(self):
+        slides = self.slides(["slide%d.swf" % i for i in range(6)])
+        with self.converter(render_jobs=2) as converter:
+            converter._convert_slides(slides)
+        self.assertLessEqual(self.tools.max_running("swfrender"), 2)
+
+    def test_errors_are_reported_for_each_slide(self):
+        slides = self.slides(["slide0.swf", "bad1.swf", "slide2.swf", "bad3.swf"])
+        with self.converter(render_jobs=2) as converter:
+            with self.assertRaises(ConversionError) as cm:
+                converter._convert_slides(slides)
+        message = str(cm.exception)
+        self.assertIn("2 of 4 slides", message)
+        self.assertIn("bad1.swf", message)
+        self.assertIn("bad3.swf", message)
+
+
+class _PipelinePresentation(object):
+
+    def __init__(self, server, slides):
+        self.client = client.InfoQ(jobs=4)
+        self.metadata = {
+            'video_url': "rtmp://localhost/video",
+            'video_path': "mp4:presentations/video.mp4",
+            'slides': [server.url("/" + s) for s in slides],
+        }
+
+
+@unittest.skipIf(sys.platform.startswith("win32"), "requires an executable script")
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tools = test.FakeTools(self.tmp_dir, delays={"swfrender": 0.3, "rtmpdump": 1})
+        self.slides = ["slide%d.swf" % i for i in range(4)]
+        self.resources = dict(("/" + s, b"swf") for s in self.slides)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def converter(self, presentation):
+        return convert.Converter(presentation, os.path.join(self.tmp_dir, "output.avi"), overwrite=False,
+                                 type="h264", jobs=4, render_jobs=4, pipeline=True, **self.tools.paths)
+
+    def test_overlap(self):
+        with test.LocalServer(self.resources, delay=0.2) as server:
+            with self.converter(_PipelinePresentation(server, self.slides)) as converter:
+                video, pngs = converter._download_and_convert()
+
+                self.assertEqual(video, converter._video_path)
+                self.assertEqual([os.path.basename(p) for p in pngs], ["slide%d.png" % i for i in range(4)])
+        # The slides are rendered while the video is downloaded
+        self.assertTrue(self.tools.overlapped("rtmpdump", "swfrender"))
+        self.assertLessEqual(self.tools.max_running("swfrender"), 4)
+
+    def test_cached_video_outlives_eviction(self):
+        with test.LocalServer(self.resources) as server:
+            presentation = _PipelinePresentation(server, self.slides)
+        presentation.client.cache = cache.XDGCache()
+        presentation.client.cache.dir = os.path.join(self.tmp_dir, "cache")
+        video = os.path.join(self.tmp_dir, "video.mp4")
+        with open(video, "w") as f:
+            f.write("video")
+        presentation.client.cache.put_path(presentation.metadata['video_path'], video)
+
+        with self.converter(presentation) as converter:
+            video_path = converter.download_video()
+            self.assertEqual(video_path, converter._video_path)
+            # Evicted by the resources put while the presentation is converted
+            presentation.client.cache.prune(0)
+            with open(video_path) as f:
+                self.assertEqual(f.read(), "video")
+        self.assertEqual(self.tools.calls(), [])
+
+    def test_slide_download_error(self):
+        del self.resources["/slide2.swf"]
+        with test.LocalServer(self.resources) as server:
+            with self.converter(_PipelinePresentation(server, self.slides)) as converter:
+                with self.assertRaises(client.DownloadError):
+                    converter._download_and_convert()
+
+
+class _TimelinePresentation(object):
+
+    def __init__(self, timecodes):
+        self.metadata = {'timecodes': timecodes}
+
+
+class TestTimeline(unittest.TestCase):
+
+    def converter(self, timecodes, type="h264"):
+        return convert.Converter(_TimelinePresentation(timecodes), "output.mp4", ffmpeg="ffmpeg",
+                                 rtmpdump="rtmpdump", swfrender="swfrender", overwrite=False, type=type,
+                                 timeline=True)
+
+    def test_timeline(self):
+        with self.converter([0, 42, 42, 128]) as converter:
+            slides = [os.path.join(converter.tmp_dir, name) for name in ["sl1.png", "sl2.png", "it's.png"]]
+            timeline = converter._prepare_timeline(slides)
+            with open(timeline) as f:
+                lines = f.read().splitlines()
+
+            self.assertEqual(lines, [
+                "ffconcat version 1.0",
+                "file '%s'" % slides[0],
+                "duration 42",
+                "file '%s'" % slides[2].replace("'", "'\\''"),
+                "duration 86",
+                "file '%s'" % slides[2].replace("'", "'\\''"),
+            ])
+            # No frame per second
+            self.assertEqual(os.listdir(converter.tmp_dir), ["timeline.ffconcat"])
+
+            cmd = converter._ffmpeg_h264("audio.mp4", timeline)
+            self.assertIn("concat", cmd)
+            self.assertEqual(cmd[cmd.index(timeline) - 1], "-i")
+
+    def test_h264_only(self):
+        with self.converter([0, 42], type="legacy") as converter:
+            self.assertFalse(converter._use_timeline)
+        with self.converter([0, 42], type="h264_overlay") as converter:
+            self.assertFalse(converter._use_timeline)
+
+    def test_variable_frame_rate(self):
+        with self.converter([0, 42, 128], type="h264_vfr") as converter:
+            slides = [os.path.join(converter.tmp_dir, name) for name in ["sl1.png", "sl2.png"]]
+            timeline = converter._prepare_timeline(slides)
+            cmd = converter._ffmpeg_h264_vfr("audio.mp4", timeline)
+
+            self.assertTrue(converter._use_timeline)
+            self.assertEqual(cmd[cmd.index(timeline) - 1], "-i")
+            self.assertEqual(cmd[cmd.index("-vsync") + 1], "vfr")
+            # No constant output frame rate
+            self.assertNotIn("-r", cmd)
+
+    def test_segments(self):
+        with self.converter([0, 30, 40, 50, 100, 110, 120]) as converter:
+            converter.segments = 3
+            slides = [os.path.join(converter.tmp_dir, "sl%d.png" % i) for i in range(6)]
+            segments = converter._prepare_segments(slides)
+
+            self.assertTrue(converter._use_segments)
+            # Split at slide changes
+            self.assertEqual([duration for timeline, duration in segments], [40, 60, 20])
+            with open(segments[1][0]) as f:
+                self.assertEqual(f.read().splitlines(), [
+                    "ffconcat version 1.0",
+                    "file '%s'" % slides[2],
+                    "duration 10",
+                    "file '%s'" % slides[3],
+                    "duration 50",
+                    "file '%s'" % slides[3],
+                ])
+
+
+def _has_ffmpeg():
+    try:
+        with open(os.devnull, 'w') as null:
+            subprocess.call(["ffmpeg", "-version"], stdout=null, stderr=null)
+        return True
+    except OSError:
+        return False
+
+
+@unittest.skipUnless(_has_ffmpeg(), "requires ffmpeg")
+class TestSegmentedEncoding(unittest.TestCase):
+
+    # Slide changes, in seconds, and the colors of the slides
+    TIMECODES = [0, 3, 7, 8, 12, 15]
+    COLORS = ["black", "white", "gray", "white", "black"]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ffmpeg("-f", "lavfi", "-i", "sine=d=15", "-f", "lavfi", "-i", "testsrc=d=15:size=320x240",
+                    "-c:a", "aac", "-c:v", "libx264", "-shortest", self.path("video.mkv"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def ffmpeg(self, *args):
+        return subprocess.check_output(["ffmpeg", "-v", "error", "-y"] + list(args), stderr=subprocess.STDOUT)
+
+    def encode(self, type, output):
+        presentation = _TimelinePresentation(self.TIMECODES)
+        with convert.Converter(presentation, output, ffmpeg="ffmpeg", rtmpdump="rtmpdump", swfrender="swfrender",
+                               overwrite=True, type=type, segments=3) as converter:
+            slides = []
+            for i, color in enumerate(self.COLORS):
+                slides.append(os.path.join(converter.tmp_dir, "slide%d.png" % i))
+                self.ffmpeg("-f", "lavfi", "-i", "color=%s:size=640x480" % color, "-frames:v", "1", slides[-1])
+            converter._assemble(self.path("video.mkv"), converter._prepare_segments(slides))
+
+    def slide_changes(self, output):
+        """ Times at which the luma of the slide track changes """
+        log = subprocess.check_output(["ffmpeg", "-i", output, "-map", "0:v", "-vf", "showinfo", "-f", "null", "-"],
+                                      stderr=subprocess.STDOUT).decode("utf-8")
+        frames = [(float(t), int(y)) for t, y in re.findall(r"pts_time:(\S+).*?mean:\[(\d+)", log)]
+        self.assertEqual(frames[0][0], 0)
+        return [t for (t, y), (_, previous) in zip(frames[1:], frames) if abs(y - previous) > 20]
+
+    def duration(self, output):
+        log = subprocess.check_output(["ffmpeg", "-i", output, "-map", "0:a", "-f", "null", "-"],
+                                      stderr=subprocess.STDOUT).decode("utf-8")
+        h, m, s = re.findall(r"time=(\d+):(\d+):(\S+)", log)[-1]
+        return int(h) * 3600 + int(m) * 60 + float(s)
+
+    def check_sync(self, type, output):
+        self.encode(type, output)
+        # The slides change at their time codes, whichever segment they belong to
+        self.assertEqual(self.slide_changes(output), self.TIMECODES[1:-1])
+        # The audio track is kept whole
+        self.assertAlmostEqual(self.duration(output), 15, delta=0.1)
+
+    def test_h264(self):
+        self.check_sync("h264", self.path("output.avi"))
+
+    def test_h264_vfr(self):
+        self.check_sync("h264_vfr", self.path("output.mkv"))
+
+
+@unittest.skipIf(sys.platform.startswith("win32"), "requires an executable script")
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tools = test.FakeTools(self.tmp_dir)
+        self.work_dir = os.path.join(self.tmp_dir, "work")
+        self.output = os.path.join(self.tmp_dir, "output.avi")
+        self.slides = ["slide%d.swf" % i for i in range(3)]
+        self.resources = dict(("/" + s, b"swf") for s in self.slides)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_presentation(self, server, **kwargs):
+        presentation = _PipelinePresentation(server, self.slides)
+        presentation.metadata['timecodes'] = [0, 3, 7, 10]
+        kwargs.update(self.tools.paths)
+        with convert.Converter(presentation, self.output, type="h264", overwrite=False, work_dir=self.work_dir,
+                               **kwargs) as converter:
+            converter.create_presentation()
+
+    def test_resume(self):
+        with test.LocalServer(self.resources) as server:
+            # ffmpeg fails
+            self.tools.failing("ffmpeg")
+            with self.assertRaises(ConversionError):
+                self.create_presentation(server)
+            self.assertEqual(sorted(self.tools.calls()), ["ffmpeg", "rtmpdump"] + ["swfrender"] * 3)
+            self.assertEqual(server.requests, 3)
+            self.assertTrue(os.path.exists(os.path.join(self.work_dir, "checkpoints.json")))
+
+            # The next attempt only runs ffmpeg
+            self.tools.failing("ffmpeg", False)
+            self.create_presentation(server)
+            self.assertEqual(self.tools.calls(), ["ffmpeg"])
+            self.assertEqual(server.requests, 3)
+
+        self.assertTrue(os.path.exists(self.output))
+        # The work directory is removed once the presentation is created
+        self.assertFalse(os.path.exists(self.work_dir))
+
+    def test_resume_pipeline_without_video(self):
+        with test.LocalServer(self.resources) as server:
+            self.tools.failing("ffmpeg")
+            with self.assertRaises(ConversionError):
+                self.create_presentation(server, pipeline=True)
+
+            # The recorded video is gone, e.g. deleted by hand
+            with open(os.path.join(self.work_dir, "checkpoints.json")) as f:
+                os.unlink(json.load(f)["pipeline"][0])
+            self.tools.failing("ffmpeg", False)
+            self.tools.calls()
+            self.create_presentation(server, pipeline=True)
+            self.assertIn("rtmpdump", self.tools.calls())
+
+        self.assertTrue(os.path.exists(self.output))
+
+    def test_work_dir_in_use(self):
+        os.makedirs(self.work_dir)
+        with open(os.path.join(self.work_dir, "lock"), "w") as f:
+            f.write(str(os.getpid()))
+        with test.LocalServer(self.resources) as server:
+            with self.assertRaises(ConversionError):
+                self.create_presentation(server)
+        self.assertEqual(self.tools.calls(), [])
+        # The lock of the other conversion is left alone
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, "lock")))
+
+    @unittest.skipIf(sys.platform.startswith("win32"), "the owner of a lock is not checked on Windows")
+    def test_stale_lock(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        os.makedirs(self.work_dir)
+        with open(os.path.join(self.work_dir, "lock"), "w") as f:
+            f.write(str(process.pid))
+        with test.LocalServer(self.resources) as server:
+            self.create_presentation(server)
+        self.assertTrue(os.path.exists(self.output))
+
+    def test_lock_released_on_failure(self):
+        with test.LocalServer(self.resources) as server:
+            self.tools.failing("ffmpeg")
+            with self.assertRaises(ConversionError):
+                self.create_presentation(server)
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, "checkpoints.json")))
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "lock")))
+
+
+class TestWorkDirs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ["XDG_CACHE_HOME"] = self.tmp_dir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def make_work_dir(self, id, size):
+        work_dir = convert.find_work_dir(id)
+        os.makedirs(work_dir)
+        with open(os.path.join(work_dir, "video.avi"), "wb") as f:
+            f.write(b"x" * size)
+        return work_dir
+
+    def test_size(self):
+        self.assertEqual(convert.work_dirs_size(), 0)
+        self.make_work_dir("foo", 1000)
+        self.make_work_dir("bar", 500)
+        self.assertEqual(convert.work_dirs_size(), 1500)
+
+    def test_clear_skips_work_dirs_in_use(self):
+        self.make_work_dir("foo", 1000)
+        in_use = self.make_work_dir("bar", 500)
+        with open(os.path.join(in_use, "lock"), "w") as f:
+            f.write(str(os.getpid()))
+
+        self.assertEqual(convert.clear_work_dirs(), 1000)
+        self.assertEqual(os.listdir(convert.find_work_root()), ["bar"])
+        with self.assertRaises(ConversionError):
+            convert.remove_work_dir(in_use)
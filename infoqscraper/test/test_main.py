@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import six
+import sys
+import tempfile
+
+from infoqscraper import client
+from infoqscraper import main
+from infoqscraper import test
+
+from infoqscraper.test.compat import unittest
+
+
+class _BrokenClient(object):
+    """ A web client failing to serve presentation pages in various ways """
+
+    authenticated = False
+    cache = None
+
+    def __init__(self):
+        self.fetched = []
+
+    def fetch(self, url, max_age=None):
+        id = url.rsplit("/", 1)[-1]
+        self.fetched.append(id)
+        if id == "missing":
+            raise client.DownloadError("404")
+        if id == "broken":
+            raise RuntimeError("Connection reset")
+        # Not a presentation page, the scraper fails to parse it
+        return b"<html><body></body></html>"
+
+
+@unittest.skipIf(sys.platform.startswith("win32"), "requires an executable script")
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tools = test.FakeTools(self.tmp_dir)
+        self.environ = dict(os.environ)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.tmp_dir, "cache")
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, infoq_client, identifiers):
+        args = ["--ffmpeg", self.tools.paths["ffmpeg"], "--swfrender", self.tools.paths["swfrender"],
+                "--rtmpdump", self.tools.paths["rtmpdump"]] + identifiers
+        stderr = sys.stderr
+        sys.stderr = six.StringIO()
+        try:
+            code = main.PresentationModule.PresentationDownload().main(infoq_client, args)
+            return code, sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+    def test_batch_survives_unexpected_errors(self):
+        infoq_client = _BrokenClient()
+        code, message = self.download(infoq_client, ["broken", "missing", "garbled"])
+
+        self.assertEqual(code, 2)
+        self.assertEqual(sorted(infoq_client.fetched), ["broken", "garbled", "missing"])
+        self.assertIn("Failed to create presentation broken:", message)
+        self.assertIn("RuntimeError: Connection reset", message)
+        self.assertIn("Presentation missing not found", message)
+        self.assertIn("Failed to create presentation garbled:", message)
+        self.assertIn("AttributeError", message)
+        # With the traceback
+        self.assertIn("scrap.py", message)
+        self.assertIn("3 of 3 presentations failed", message)
+
+    def test_unexpected_error_of_a_single_presentation(self):
+        with self.assertRaises(RuntimeError):
+            self.download(_BrokenClient(), ["broken"])
+
+    def test_input_file(self):
+        input_path = os.path.join(self.tmp_dir, "ids")
+        with open(input_path, "w") as f:
+            f.write("# Presentations\nmissing\n\nbroken\n")
+        infoq_client = _BrokenClient()
+        code, message = self.download(infoq_client, ["--input", input_path])
+        self.assertEqual(sorted(infoq_client.fetched), ["broken", "missing"])
+        self.assertIn("2 of 2 presentations failed", message)
+
+    def test_duplicates(self):
+        infoq_client = _BrokenClient()
+        self.download(infoq_client, ["missing", "http://www.infoq.com/presentations/missing"])
+        self.assertEqual(infoq_client.fetched, ["missing"])
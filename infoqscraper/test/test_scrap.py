@@ -22,9 +22,16 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import bs4
 import datetime
+import os
+import re
+import shutil
 import six
+import tempfile
+import timeit
 
+from infoqscraper import cache
 from infoqscraper import client
 from infoqscraper import scrap
 from infoqscraper import test
@@ -172,3 +179,192 @@ class TestPresentation(unittest.TestCase):
         p = scrap.Presentation(self.iq, "immutable-infrastructure")
         self.assertIsInstance(p.metadata['demo_timings'], list)
 
+
+class TestPresentationMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.iq = client.InfoQ()
+        self.iq.cache = cache.XDGCache()
+        self.iq.cache.dir = self.cache_dir = tempfile.mkdtemp()
+        self.content = test.read_data("presentation.html")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_metadata_cached(self):
+        metadata = scrap.Presentation(self.iq, "fixture", content=self.content).metadata
+        self.assertEqual(metadata['date'], datetime.datetime(2014, 6, 12))
+
+        p = scrap.Presentation(self.iq, "fixture", content=self.content)
+        self.assertEqual(p.metadata, metadata)
+        # The page has not been parsed
+        self.assertFalse(hasattr(p, "_soup"))
+
+    def test_page_changed(self):
+        scrap.Presentation(self.iq, "fixture", content=self.content).metadata
+        content = self.content.replace("Jun 12, 2014", "Jul 14, 2014")
+        p = scrap.Presentation(self.iq, "fixture", content=content)
+        self.assertEqual(p.metadata['date'], datetime.datetime(2014, 7, 14))
+        self.assertTrue(hasattr(p, "_soup"))
+
+    def test_login_after_anonymous_fetch(self):
+        url = client.get_url("/presentations/fixture")
+        self.iq.cache.put_content(url, self.content.encode('utf-8'))
+        self.assertEqual(scrap.Presentation(self.iq, "fixture").metadata['date'], datetime.datetime(2014, 6, 12))
+
+        # The page of an authenticated client is fetched again, not read from the cache
+        self.iq.authenticated = True
+        fetched = []
+        content = self.content.replace("Jun 12, 2014", "Jul 14, 2014")
+        def fetch_no_cache(url):
+            fetched.append(url)
+            return content.encode('utf-8')
+        self.iq.fetch_no_cache = fetch_no_cache
+        p = scrap.Presentation(self.iq, "fixture")
+        self.assertEqual(fetched, [url])
+        self.assertEqual(p.metadata['date'], datetime.datetime(2014, 7, 14))
+
+    def test_extractor_changed(self):
+        scrap.Presentation(self.iq, "fixture", content=self.content).metadata
+        version = scrap.METADATA_VERSION
+        scrap.METADATA_VERSION = version + 1
+        try:
+            p = scrap.Presentation(self.iq, "fixture", content=self.content)
+            self.assertEqual(p.metadata['date'], datetime.datetime(2014, 6, 12))
+            self.assertTrue(hasattr(p, "_soup"))
+        finally:
+            scrap.METADATA_VERSION = version
+
+    def test_cache_disabled(self):
+        self.iq.cache = None
+        p = scrap.Presentation(self.iq, "fixture", content=self.content)
+        self.assertEqual(p.metadata['timecodes'], [0, 42, 128])
+
+
+class TestScriptSearch(unittest.TestCase):
+    def setUp(self):
+        self.soup = bs4.BeautifulSoup(test.read_data("presentation.html"), "html.parser")
+
+    def test_first_match_of_each_pattern(self):
+        slides, video, missing = scrap._search_scripts(self.soup, scrap._SLIDES_RE, scrap._VIDEO_RE,
+                                                       re.compile("IDONOTEXIST"))
+        self.assertTrue(slides.group(1).startswith("'/resource/presentations/fixture/en/slides/sl1.jpg'"))
+        self.assertEqual(video.group(1), "cHJlc2VudGF0aW9ucy8xNC1qdW4tZml4dHVyZS5tcDQ=")
+        self.assertIsNone(missing)
+
+    @unittest.skipUnless(os.environ.get("INFOQ_BENCHMARK"), "set INFOQ_BENCHMARK to run benchmarks")
+    def test_benchmark(self):
+        # The sample page is padded with filler scripts, standing for the dozens of scripts
+        # (analytics, ads, widgets) InfoQ pages embed before the player ones
+        filler = "".join("<script>var widget%d = {id: %d, enabled: true};</script>" % (i, i) for i in range(100))
+        content = test.read_data("presentation.html").replace('<div class="player">', '<div class="player">' + filler)
+        soup = bs4.BeautifulSoup(content, "html.parser")
+        patterns = [scrap._TIMECODES_RE, scrap._DEMO_TIMINGS_RE, scrap._SLIDES_RE, scrap._VIDEO_RE]
+
+        def one_pass():
+            return scrap._search_scripts(soup, *patterns)
+
+        def one_pass_per_pattern():
+            # How the scripts used to be searched
+            matches = []
+            for pattern in patterns:
+                for script in soup.find_all('script'):
+                    mo = re.search(pattern.pattern, script.string or "")
+                    if mo:
+                        break
+                matches.append(mo)
+            return matches
+
+        self.assertEqual([m.group(0) for m in one_pass()], [m.group(0) for m in one_pass_per_pattern()])
+        single = min(timeit.repeat(one_pass, number=20, repeat=3))
+        multiple = min(timeit.repeat(one_pass_per_pattern, number=20, repeat=3))
+        # Each script text is materialized once rather than once per pattern
+        self.assertGreater(multiple / single, 1.5)
+
+
+class TestParsers(unittest.TestCase):
+    """Every parser must extract the same data from the sample pages"""
+
+    def setUp(self):
+        self.iq = client.InfoQ()
+        self.presentation = test.read_data("presentation.html")
+        self.presentations = test.read_data("presentations.html")
+
+    def assert_parity(self, parser):
+        try:
+            bs4.BeautifulSoup("", parser)
+        except bs4.FeatureNotFound:
+            self.skipTest("%s is not installed" % parser)
+
+        reference = scrap.Presentation(self.iq, "fixture", content=self.presentation, parser="html.parser")
+        p = scrap.Presentation(self.iq, "fixture", content=self.presentation, parser=parser)
+        self.assertEqual(p.metadata, reference.metadata)
+
+        reference = scrap._RightBarPage(self.iq, 0, content=self.presentations, parser="html.parser")
+        rb = scrap._RightBarPage(self.iq, 0, content=self.presentations, parser=parser)
+        self.assertEqual(rb.summaries(), reference.summaries())
+        self.assertEqual(len(rb.summaries()), 12)
+
+    def test_html_parser(self):
+        self.assert_parity("html.parser")
+
+    def test_lxml(self):
+        self.assert_parity("lxml")
+
+    def test_html5lib(self):
+        self.assert_parity("html5lib")
+
+    def test_default_parser(self):
+        p = scrap.Presentation(self.iq, "fixture", content=self.presentation)
+        self.assertEqual(p.parser, scrap.DEFAULT_PARSER)
+        self.assertEqual(p.metadata['timecodes'], [0, 42, 128])
+
+
+class TestListingPage(unittest.TestCase):
+    def test_only_summaries_are_parsed(self):
+        rb = scrap._RightBarPage(client.InfoQ(), 0, content=test.read_data("presentations.html"))
+        self.assertEqual(len(rb.summaries()), 12)
+        self.assertIsNone(rb.soup.find('div', id='footer'))
+        self.assertEqual(len(rb.soup.find_all('script')), 0)
+
+
+class TestSummariesPrefetch(unittest.TestCase):
+    def ids(self, summaries):
+        return [s['id'] for s in summaries]
+
+    def test_all_pages(self):
+        iq = test.ListingClient(70)
+        summaries = list(scrap.get_summaries(iq, prefetch=4))
+        self.assertEqual(self.ids(summaries), ["p%d" % i for i in range(70)])
+        # The last page is smaller, the end of the listing is checked at the right index
+        self.assertIn(70, iq.fetched)
+
+    def test_same_as_sequential(self):
+        sequential = list(scrap.get_summaries(test.ListingClient(30)))
+        self.assertEqual(list(scrap.get_summaries(test.ListingClient(30), prefetch=2)), sequential)
+
+    def test_max_pages(self):
+        iq = test.ListingClient(100)
+        summaries = list(scrap.get_summaries(iq, filter=scrap.MaxPagesFilter(2), prefetch=4))
+        self.assertEqual(self.ids(summaries), ["p%d" % i for i in range(24)])
+        self.assertEqual(sorted(iq.fetched), [0, 12])
+
+    def test_early_stop(self):
+        iq = test.ListingClient(1000)
+        summaries = scrap.get_summaries(iq, prefetch=3)
+        for i in range(5):
+            next(summaries)
+        summaries.close()
+        self.assertLessEqual(len(iq.fetched), 4)
+
+    def test_page_size_change(self):
+        iq = test.ListingClient(50, page_size=10)
+        first = test.ListingClient.fetch
+
+        def fetch(self, url, max_age=None):
+            # The first page is larger than the next ones
+            self.page_size = 12 if url.endswith("/0") else 10
+            return first(self, url, max_age)
+
+        iq.fetch = fetch.__get__(iq)
+        summaries = list(scrap.get_summaries(iq, prefetch=3))
+        self.assertEqual(self.ids(summaries), ["p%d" % i for i in range(50)])
@@ -23,6 +23,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from distutils.command.build_py import build_py
 from distutils.core import setup
 import sys
 
@@ -35,6 +36,19 @@ install_requires=[
 if sys.version_info < (2, 7):
     install_requires += ['argparse']
 
+if sys.version_info < (3, 2):
+    install_requires += ['futures']
+
+
+class BuildPy(build_py):
+    """Leave out infoqscraper.aio before Python 3.6, it uses async generators"""
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 6):
+            modules = [m for m in modules if (m[0], m[1]) != ("infoqscraper", "aio")]
+        return modules
+
 
 setup(
     version="0.1.6-dev",
@@ -62,5 +76,6 @@ infoqscraper allows to scrap the website, download the required resources and bu
     packages=["infoqscraper"],
     scripts=["bin/infoqscraper"],
     install_requires=install_requires,
+    cmdclass={"build_py": BuildPy},
 )
 